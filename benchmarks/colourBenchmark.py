@@ -0,0 +1,125 @@
+"""Compares the speed and agreement of the dominant colour backends
+
+Usage: python -m benchmarks.colourBenchmark [image directory] [--runs N]
+
+Without a directory a fixture set of generated images is used, shaped like
+typical profile pictures: flat logos, gradients, photos-ish noise and transparent cut-outs.
+Agreement is measured against the kmeans backend, as that is what the bot originally used.
+kmeans starts from random centroids, so on images without a clear dominant colour (gradient.jpg)
+its answer changes from run to run, and the backends are not expected to agree there
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import typing
+from time import perf_counter
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from source import colour  # noqa: E402
+
+REFERENCE = "kmeans"
+AGREEMENT_DISTANCE = 40
+"""The largest euclidean RGB distance that counts as the same colour"""
+
+
+def _encode(im: Image.Image, fmt: str) -> bytes:
+    buffer = io.BytesIO()
+    im.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def fixtureImages(size: int = 300) -> typing.Dict[str, bytes]:
+    """Generates a reproducible set of test images"""
+    rng = np.random.default_rng(404)
+    images = {}
+
+    solid = np.zeros((size, size, 3), dtype=np.uint8)
+    solid[:] = (100, 65, 165)
+    images['solid.png'] = _encode(Image.fromarray(solid), "PNG")
+
+    logo = solid.copy()
+    logo[size // 4:3 * size // 4, size // 4:3 * size // 4] = (240, 240, 240)
+    images['logo.png'] = _encode(Image.fromarray(logo), "PNG")
+
+    gradient = np.zeros((size, size, 3), dtype=np.uint8)
+    gradient[..., 0] = np.linspace(0, 255, size, dtype=np.uint8)[None, :]
+    gradient[..., 2] = 180
+    images['gradient.jpg'] = _encode(Image.fromarray(gradient), "JPEG")
+
+    for i in range(5):
+        base = rng.integers(0, 256, 3)
+        noisy = np.clip(base + rng.normal(0, 25, (size, size, 3)), 0, 255).astype(np.uint8)
+        images[f'noise{i}.jpg'] = _encode(Image.fromarray(noisy), "JPEG")
+
+    cutout = np.zeros((size, size, 4), dtype=np.uint8)
+    yy, xx = np.mgrid[:size, :size]
+    circle = (yy - size / 2) ** 2 + (xx - size / 2) ** 2 < (size / 3) ** 2
+    cutout[circle] = (230, 90, 30, 255)
+    images['cutout.png'] = _encode(Image.fromarray(cutout, "RGBA"), "PNG")
+
+    large = np.clip(rng.normal(128, 40, (1024, 1024, 3)), 0, 255).astype(np.uint8)
+    large[:600] = (20, 120, 60)
+    images['large.png'] = _encode(Image.fromarray(large), "PNG")
+    return images
+
+
+def loadDirectory(path: str) -> typing.Dict[str, bytes]:
+    images = {}
+    for name in sorted(os.listdir(path)):
+        with open(os.path.join(path, name), "rb") as f:
+            images[name] = f.read()
+    return images
+
+
+def distance(a: typing.Union[int, None], b: typing.Union[int, None]) -> float:
+    if a is None or b is None:
+        return 0 if a == b else float("inf")
+    a = np.array([(a >> 16) & 255, (a >> 8) & 255, a & 255], dtype=float)
+    b = np.array([(b >> 16) & 255, (b >> 8) & 255, b & 255], dtype=float)
+    return float(np.linalg.norm(a - b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", nargs="?", help="A directory of images to use instead of the fixtures")
+    parser.add_argument("--runs", type=int, default=5, help="How many times to time each image")
+    args = parser.parse_args()
+
+    images = loadDirectory(args.directory) if args.directory else fixtureImages()
+    results = {name: {} for name in colour.BACKENDS}
+    timings = {name: [] for name in colour.BACKENDS}
+
+    for backend, extractor in colour.BACKENDS.items():
+        for imageName, data in images.items():
+            runs = []
+            for _ in range(args.runs):
+                start = perf_counter()
+                results[backend][imageName] = extractor(data)
+                runs.append(perf_counter() - start)
+            timings[backend].append(statistics.median(runs))
+
+    print(f"{len(images)} images, median of {args.runs} runs each\n")
+    print(f"{'backend':<12}{'mean ms':>10}{'total ms':>10}{'agreement':>12}")
+    for backend in colour.BACKENDS:
+        agreed = sum(distance(results[backend][i], results[REFERENCE][i]) <= AGREEMENT_DISTANCE for i in images)
+        print(f"{backend:<12}"
+              f"{statistics.mean(timings[backend]) * 1000:>10.2f}"
+              f"{sum(timings[backend]) * 1000:>10.2f}"
+              f"{agreed:>7}/{len(images):<4}")
+
+    print(f"\n{'image':<16}" + "".join(f"{b:>12}" for b in colour.BACKENDS))
+    for imageName in images:
+        print(f"{imageName:<16}" + "".join(
+            f"{'none' if results[b][imageName] is None else f'#{results[b][imageName]:06x}':>12}"
+            for b in colour.BACKENDS
+        ))
+
+
+if __name__ == '__main__':
+    main()
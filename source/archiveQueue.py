@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import traceback
+import typing
+
+import discord
+
+from . import utilities
+from .databaseManager import DBConnector
+
+log: logging.Logger = utilities.getLog("archiveQueue", logging.INFO)
+
+RETRY_DELAY = 30
+"""Seconds before the first retry of an archive that failed, doubling with each attempt"""
+
+MAX_RETRY_DELAY = 30 * 60
+"""The longest an archive waits between retries"""
+
+
+class ArchiveQueue:
+    """Archives posted notifications in the background
+
+    Queued messages are flagged in twitching.postedMessages, so anything still pending when the bot stops
+    is picked up again by `load`. Each channel is edited one message at a time, as discord rate limits
+    edits per channel, and the total number of edits in flight is bounded. An edit that fails for any reason
+    other than the message being gone, or us losing access to it, is retried with backoff"""
+
+    def __init__(self, db: DBConnector, archiveFunc: typing.Callable[[dict], typing.Awaitable],
+                 concurrency: int = 10, flushInterval: float = 5,
+                 owns: typing.Callable[[dict], bool] = None):
+        self.db = db
+        self.archiveFunc = archiveFunc
+        """Archives a single postedMessages row"""
+
+        self.owns = owns
+        """Filters which pending archives `load` resumes, ie when other processes share the table"""
+
+        self.concurrency = concurrency
+        self.flushInterval = flushInterval
+
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.channelLocks: typing.Dict[str, typing.List] = {}
+        """Channel ID -> [lock, how many workers hold or are waiting on it], only while in use"""
+        self.done: typing.List[str] = []
+        """Archived message IDs waiting to be removed from the database"""
+
+        self.retries: typing.Dict[str, int] = {}
+        """Message ID -> how many times archiving it has failed, for those waiting to be retried"""
+        self._retryHandles: typing.Dict[str, asyncio.TimerHandle] = {}
+
+        self.archived = 0
+        self.failed = 0
+        self._tasks: typing.List[asyncio.Task] = []
+
+    @property
+    def pending(self) -> int:
+        return self.queue.qsize() + len(self._retryHandles)
+
+    def start(self):
+        """Starts the workers"""
+        if self._tasks:
+            return
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.ensure_future(self._flusher()))
+
+    async def stop(self):
+        """Stops the workers, anything unfinished stays flagged in the database"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for handle in self._retryHandles.values():
+            handle.cancel()
+        self._retryHandles = {}
+        self.retries = {}
+        self.queue = asyncio.Queue()
+        await self.flush()
+
+    async def load(self):
+        """Queues any archives left unfinished by a previous run"""
+        count = 0
+        async for row in self.db.fetch_iter("SELECT * FROM twitching.postedMessages WHERE archiving = 1"):
+            if self.owns is None or self.owns(row):
+                self.queue.put_nowait(row)
+                count += 1
+        if count:
+            log.info(f"Resuming {count} pending archives")
+
+    async def enqueue(self, rows: typing.List[dict]):
+        """Flags messages as being archived, and queues them"""
+        if not rows:
+            return
+        await self.db.execute(
+            "UPDATE twitching.postedMessages SET archiving = 1 "
+            f"WHERE messageID IN ({', '.join(['%s'] * len(rows))})",
+            tuple(row['messageID'] for row in rows)
+        )
+        for row in rows:
+            self.queue.put_nowait(row)
+
+    async def flush(self):
+        """Removes archived messages from the database"""
+        if not self.done:
+            return
+        done, self.done = self.done, []
+        await self.db.execute(
+            f"DELETE FROM twitching.postedMessages WHERE messageID IN ({', '.join(['%s'] * len(done))})",
+            tuple(done)
+        )
+
+    def _retry(self, row: dict):
+        """Queues a failed archive again once its backoff has passed, it stays flagged in the meantime"""
+        messageID = row['messageID']
+        attempts = self.retries.get(messageID, 0) + 1
+        self.retries[messageID] = attempts
+        delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (attempts - 1))
+        log.debug(f"Retrying archiving {messageID} in {delay}s (attempt {attempts})")
+
+        def requeue():
+            self._retryHandles.pop(messageID, None)
+            self.queue.put_nowait(row)
+
+        self._retryHandles[messageID] = asyncio.get_event_loop().call_later(delay, requeue)
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flushInterval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f"Failed to flush archived messages: {e}")
+
+    async def _worker(self):
+        while True:
+            row = await self.queue.get()
+            entry = self.channelLocks.setdefault(row['channelID'], [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await self.archiveFunc(row)
+                self.archived += 1
+            except asyncio.CancelledError:
+                raise
+            except (discord.NotFound, discord.Forbidden) as ex:
+                # the message was deleted, or we lost access, either way retrying won't help
+                self.failed += 1
+                log.error(f"Giving up archiving {row['messageID']}: {ex}")
+            except Exception as ex:
+                log.error('Ignoring exception archiving {}: {}'.format(
+                    row['messageID'], "".join(traceback.format_exception(type(ex), ex, ex.__traceback__))))
+                self._retry(row)
+                continue
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    # nobody else is using this channel's lock
+                    del self.channelLocks[row['channelID']]
+                self.queue.task_done()
+            self.retries.pop(row['messageID'], None)
+            self.done.append(row['messageID'])
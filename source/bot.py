@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import os
 import re
 import traceback
 from datetime import datetime
@@ -10,12 +11,16 @@ import discord_slash
 from discord.ext import commands
 from discord_slash import SlashCommand, SlashContext, error
 
-from . import utilities, dataclass
+from . import utilities, dataclass, migrations
 
 log: logging.Logger = utilities.getLog("Bot", level=logging.DEBUG)
 intents = discord.Intents.default()
 intents.members = True
 
+# when running as several processes, each is given the shards it connects
+shardCount = os.environ.get("TWITCHING_SHARD_COUNT")
+shardIDs = os.environ.get("TWITCHING_SHARD_IDS")
+
 bot = dataclass.Bot(
     command_prefix="twitching ",
     description="A twitch notifs bot",
@@ -25,7 +30,9 @@ bot = dataclass.Bot(
         'source.cogs.base',
         'source.cogs.twitch'
     ],
-    help_command=None
+    help_command=None,
+    shard_count=int(shardCount) if shardCount else None,
+    shard_ids=[int(s) for s in shardIDs.split(",")] if shardIDs else None
 )
 slash = SlashCommand(bot, sync_commands=False, override_type=True)  # register a slash command system
 
@@ -45,11 +52,14 @@ def run():
     bot.run(utilities.getCredential("botToken"), bot=True, reconnect=True)
 
 
-async def startupTasks():
-    """All the tasks the bot needs to run when it starts up"""
+async def startupTasks() -> bool:
+    """All the tasks the bot needs to run when it starts up
+
+    :return: False if startup failed, and the bot has closed"""
     log.debug("Running startup tasks...")
     bot.appInfo = await bot.application_info()
     bot.startTime = datetime.now()
+    bot.createSession()
     await bot.change_presence(status=discord.Status.do_not_disturb, activity=discord.Game("Startup"))
 
     log.info("Establishing connection to database...")
@@ -58,18 +68,37 @@ async def startupTasks():
     except Exception as e:
         log.error(e)
 
+    try:
+        await migrations.migrate(bot.db)
+    except Exception as e:
+        # the cogs expect the migrated schema, the failed migration is retried on the next startup
+        log.critical(f"Failed to migrate the database, abort: {e}")
+        await bot.close()
+        return False
+
+    try:
+        await bot.cluster.start()
+    except Exception as e:
+        # without the other workers in its ring, this worker would poll every streamer
+        log.critical(f"Failed to join the cluster, abort: {e}")
+        await bot.close()
+        return False
+
     log.info("Running cog setup tasks")
     for cog in bot.cogs:
         _c = bot.get_cog(cog)
         if hasattr(_c, "setup"):
             await _c.setup()
+    # a cog may have aborted, ie if it couldn't authenticate
+    return not bot.is_closed()
 
 
 @bot.event
 async def on_ready():
     """Called when the bot is ready"""
     if not bot.startTime:
-        await startupTasks()
+        if not await startupTasks():
+            return
     log.info("INFO".center(40, "-"))
     log.info(f"Logged in as       : {bot.user.name} #{bot.user.discriminator}")
     log.info(f"User ID            : {bot.user.id}")
@@ -77,6 +106,9 @@ async def on_ready():
     log.info(f"DB Connection Type : "
              f"{'Tunneled' if bot.db.tunnel and bot.db.dbPool else 'Direct' if bot.db.dbPool else 'Not Connected'}")
     log.info(f"Server Count       : {len(bot.guilds)}")
+    log.info(f"Shards             : {', '.join(str(s) for s in bot.shards)} of {bot.shard_count}")
+    log.info(f"Worker             : "
+             f"{bot.cluster.workerID + ' of ' + str(len(bot.cluster.workers)) if bot.cluster.enabled else 'Standalone'}")
     log.info(f"Cog Count          : {len(bot.cogs)}")
     log.info(f"Command Count      : {len(slash.commands)}")
     log.info(f"Discord.py Version : {discord.__version__}")
@@ -0,0 +1,223 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import socket
+import traceback
+import typing
+
+from . import utilities
+from .databaseManager import DBConnector
+
+log: logging.Logger = utilities.getLog("cluster", logging.INFO)
+
+CLUSTERED = os.environ.get("TWITCHING_CLUSTERED", "0") == "1"
+"""Run as one of several processes, each polling a share of the streamers"""
+
+WORKER_ID = os.environ.get("TWITCHING_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+"""This process's name in twitching.workers, must be unique within the cluster"""
+
+HEARTBEAT_INTERVAL = 10
+"""Seconds between heartbeats"""
+
+WORKER_TIMEOUT = 30
+"""Seconds without a heartbeat before a worker's streamers are taken over by the others"""
+
+EVENT_INTERVAL = 1
+"""Seconds between checks for events published by other workers"""
+
+EVENT_SETTLE = 1
+"""Seconds an event must have existed before it is read, so an insert still committing isn't skipped"""
+
+EVENT_BATCH = 500
+"""The most events read per check, any more are read by the following checks"""
+
+EVENT_RETENTION = 60 * 60
+"""Seconds events are kept, only workers that are down for longer than this can miss them"""
+
+CONFIG_CHANGED = "config_changed"
+"""Published when a guild's settings change"""
+
+Handler = typing.Callable[[str, typing.Union[str, None], dict], typing.Awaitable]
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes
+
+    Each node is placed on the ring many times, so keys are spread evenly, and when a node joins
+    or leaves only the keys it gains or loses move"""
+
+    def __init__(self, nodes: typing.Iterable[str] = (), replicas: int = 64):
+        self.replicas = replicas
+        self.nodes: typing.List[str] = sorted(set(nodes))
+
+        ring = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self._points: typing.List[int] = [point for point, _ in ring]
+        self._owners: typing.List[str] = [node for _, node in ring]
+
+    def owner(self, key: str) -> typing.Union[str, None]:
+        """Gets the node a key belongs to"""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+
+class Cluster:
+    """Coordinates several bot processes through the database
+
+    Every live worker heartbeats into twitching.workers, and streamers are partitioned between them with a
+    HashRing, so each streamer is polled by exactly one worker. Stream events are published to
+    twitching.streamEvents, where every other worker picks them up and notifies the guilds it holds.
+    When disabled, this process owns everything and nothing is published, unless `startEvents` is used"""
+
+    def __init__(self, db: DBConnector, workerID: str = WORKER_ID, enabled: bool = CLUSTERED):
+        self.db = db
+        self.workerID = workerID
+        self.enabled = enabled
+        self.events = enabled
+        """Are events exchanged with other processes"""
+
+        self.ring = HashRing([workerID])
+        self.handlers: typing.List[Handler] = []
+        self.lastEventID = 0
+        self.startEventID = 0
+        """The last event published before this worker started reading them"""
+        self.stats = {"published": 0, "received": 0}
+        self._tasks: typing.List[asyncio.Task] = []
+        self._consumer: typing.Union[asyncio.Task, None] = None
+
+    @property
+    def workers(self) -> typing.List[str]:
+        return self.ring.nodes
+
+    def owns(self, key: str) -> bool:
+        """Is this worker responsible for a streamer"""
+        return not self.enabled or self.ring.owner(key) == self.workerID
+
+    def onEvent(self, handler: Handler):
+        """Calls handler with (event, userID, payload) for every event another worker publishes"""
+        self.handlers.append(handler)
+
+    async def start(self):
+        if not self.enabled or self._tasks:
+            return
+        await self.heartbeat()
+        await self.startEvents()
+        self._tasks.append(asyncio.ensure_future(self._heartbeatLoop()))
+        log.info(f"Joined cluster as {self.workerID}, {len(self.workers)} workers")
+
+    async def startEvents(self):
+        """Starts exchanging events with other processes, without partitioning streamers between them,
+        ie between a leader and its standbys"""
+        self.events = True
+        if self._consumer is not None:
+            return
+        # a failed query would otherwise start from 0, replaying every retained event
+        row = await self.db.execute("SELECT MAX(id) AS lastID FROM twitching.streamEvents", getOne=True,
+                                    raiseErrors=True)
+        self.lastEventID = self.startEventID = (row or {}).get('lastID') or 0
+        self._consumer = asyncio.ensure_future(self._consumeLoop())
+        self._tasks.append(self._consumer)
+
+    async def stop(self):
+        """Leaves the cluster, so the other workers take over immediately rather than after a timeout"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._consumer = None
+        if self.enabled:
+            await self.db.execute("DELETE FROM twitching.workers WHERE workerID = %s", (self.workerID,))
+
+    async def heartbeat(self):
+        """Records that this worker is alive, and rebuilds the ring if the set of live workers changed"""
+        await self.db.execute(
+            "INSERT INTO twitching.workers (workerID, heartbeat) VALUES (%s, NOW()) "
+            "ON DUPLICATE KEY UPDATE heartbeat = NOW()",
+            (self.workerID,)
+        )
+        rows = await self.db.execute(
+            "SELECT workerID FROM twitching.workers WHERE heartbeat > NOW() - INTERVAL %s SECOND",
+            (WORKER_TIMEOUT,)
+        )
+        if rows is None:
+            # we just wrote our own heartbeat, so the query failed, keep the ring we have
+            return
+        workers = sorted({row['workerID'] for row in rows} | {self.workerID})
+        if workers != self.workers:
+            log.info(f"Cluster changed, now {len(workers)} workers: {', '.join(workers)}")
+            self.ring = HashRing(workers)
+
+    async def publish(self, event: str, userID: typing.Union[str, None], payload: dict):
+        """Sends an event to every other worker"""
+        if not self.events:
+            return
+        await self.db.execute(
+            "INSERT INTO twitching.streamEvents (workerID, event, userID, payload) VALUES (%s, %s, %s, %s)",
+            (self.workerID, event, userID, json.dumps(payload))
+        )
+        self.stats['published'] += 1
+
+    async def latestEvents(self, events: typing.Iterable[str]) -> typing.List[typing.Tuple[str, str, dict]]:
+        """Gets each streamer's most recent event of the given types from before this worker started reading them,
+        ie to learn what other workers already know
+
+        :return: a list of (event, userID, payload)"""
+        events = list(events)
+        rows = await self.db.execute(
+            "SELECT e.event, e.userID, e.payload FROM twitching.streamEvents e JOIN ("
+            "SELECT userID, MAX(id) AS id FROM twitching.streamEvents "
+            f"WHERE event IN ({', '.join(['%s'] * len(events))}) AND id <= %s GROUP BY userID"
+            ") latest ON e.id = latest.id",
+            (*events, self.startEventID)
+        )
+        return [(row['event'], row['userID'], json.loads(row['payload'])) for row in rows or ()]
+
+    async def consume(self):
+        """Handles any events other workers have published since the last call"""
+        rows = await self.db.execute(
+            "SELECT id, workerID, event, userID, payload FROM twitching.streamEvents "
+            "WHERE id > %s AND createdAt <= NOW(3) - INTERVAL %s SECOND ORDER BY id LIMIT %s",
+            (self.lastEventID, EVENT_SETTLE, EVENT_BATCH)
+        )
+        for row in rows or ():
+            self.lastEventID = row['id']
+            if row['workerID'] == self.workerID:
+                continue
+            self.stats['received'] += 1
+            payload = json.loads(row['payload'])
+            for handler in self.handlers:
+                try:
+                    await handler(row['event'], row['userID'], payload)
+                except Exception as ex:
+                    log.error('Ignoring exception handling cluster event {}: {}'.format(
+                        row['event'], "".join(traceback.format_exception(type(ex), ex, ex.__traceback__))))
+
+    async def _heartbeatLoop(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                log.error(f"Cluster heartbeat failed: {e}")
+
+    async def _consumeLoop(self):
+        reads = 0
+        while True:
+            await asyncio.sleep(EVENT_INTERVAL)
+            try:
+                await self.consume()
+                reads += 1
+                if reads % 300 == 0:
+                    await self.db.execute(
+                        "DELETE FROM twitching.streamEvents WHERE createdAt < NOW() - INTERVAL %s SECOND",
+                        (EVENT_RETENTION,)
+                    )
+            except Exception as e:
+                log.error(f"Failed to read cluster events: {e}")
@@ -1,6 +1,5 @@
 import logging
 
-import aiohttp
 import discord
 from discord.ext import commands
 
@@ -37,16 +36,15 @@ class Base(commands.Cog):
         if await self.bot.is_owner(ctx.author):
             if ctx.message.attachments:
                 photo = ctx.message.attachments[0].url
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(photo) as r:
-                        if r.status == 200:
-                            data = await r.read()
-                            try:
-                                await self.bot.user.edit(avatar=data)
-                                return await ctx.send("Set avatar, how do i look?")
-                            except discord.HTTPException:
-                                await ctx.send("Unable to set avatar")
-                                return
+                async with self.bot.session.get(photo) as r:
+                    if r.status == 200:
+                        data = await r.read()
+                        try:
+                            await self.bot.user.edit(avatar=data)
+                            return await ctx.send("Set avatar, how do i look?")
+                        except discord.HTTPException:
+                            await ctx.send("Unable to set avatar")
+                            return
             await ctx.send("I cant read that")
 
 
@@ -1,29 +1,66 @@
 import asyncio
-import concurrent.futures
 import functools
-import json
 import logging
+import os
+import statistics
 import time
 import traceback
 import typing
+from collections import deque
+from datetime import datetime, timezone
 
 import discord
 from discord.ext import commands, tasks
 from discord_slash import cog_ext, SlashContext
 from discord_slash.utils import manage_commands
-from twitchAPI import Twitch as TwitchAPI
-from twitchAPI.types import TwitchAuthorizationException
-
 from source import utilities, dataclass
+from source.archiveQueue import ArchiveQueue
+from source.cluster import CONFIG_CHANGED
+from source.eventsub import EventSubServer, STREAM_ONLINE, STREAM_OFFLINE
+from source.guildCache import GuildConfigCache, GuildConfig
+from source.helix import HelixClient, HelixAuthorizationException, BATCH_SIZE
+from source.pollScheduler import PollScheduler
+from source.ratelimit import Priority
+from source.streamState import StreamStateTracker, StreamState, WENT_LIVE, WENT_OFFLINE, TITLE_CHANGED
 
 log: logging.Logger = utilities.getLog("Cog::twitch")
 
+GUILD_CONCURRENCY = 25
+"""How many guilds are notified at once"""
+
+USE_EVENTSUB = False
+"""Have twitch push stream.online/offline to a webhook, rather than waiting for the next poll"""
+
+EVENTSUB_HOST = "0.0.0.0"
+EVENTSUB_PORT = int(os.environ.get("TWITCHING_EVENTSUB_PORT", 8080))
+"""Each worker on a host needs its own port"""
+
+EVENTSUB_CALLBACK = os.environ.get("TWITCHING_EVENTSUB_CALLBACK")
+"""Overrides the eventSubCallback credential, each worker in a cluster needs its own callback routed to its port"""
+
+RECONCILE_INTERVAL = 10
+"""Minutes between polls when eventsub is in use, which then only catch anything eventsub missed"""
+
+EVENTSUB_TYPES = (STREAM_ONLINE, STREAM_OFFLINE)
+
+USE_POLL_LEASE = False
+"""Elect a single process to poll through a database lease, so copies of the bot can run as hot standbys
+
+Only enable this when running standbys, as every process then also checks the database for events each second"""
+
+POLL_LEASE = "twitching.poller"
 
-class SetEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        return json.JSONEncoder.default(self, obj)
+POLL_BUDGET = 400
+"""Helix requests per minute polling may use, leaving the rest of the limit for commands and eventsub"""
+
+NOTIFY_RETRY_DELAY = 60
+"""Seconds before a notification that failed to post is retried, doubling with each attempt"""
+
+MAX_NOTIFY_RETRY_DELAY = 30 * 60
+"""The longest a notification waits between retries"""
+
+DEFAULT_COLOUR = discord.Colour(0x9146FF)
+"""Used when a profile image's dominant colour can't be found, ie it is too large or fully transparent"""
 
 
 class Twitch(commands.Cog):
@@ -34,22 +71,119 @@ class Twitch(commands.Cog):
 
         self.slash = bot.slash
 
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
-        self.twitch = TwitchAPI(app_id=utilities.getCredential("twitchAppID"),
-                                app_secret=utilities.getCredential("twitchSecret"))
+        self.twitch = HelixClient(app_id=utilities.getCredential("twitchAppID"),
+                                  app_secret=utilities.getCredential("twitchSecret"))
+        self.configCache = GuildConfigCache(bot.db)
+        self.archiveQueue = ArchiveQueue(bot.db, self.archiveMessage, owns=self.ownsMessage)
+
+        self.liveStreams: typing.Dict[str, typing.Set[str]] = {}
+        """Streamer login -> IDs of their streams with notifications that haven't been archived"""
+
+        self.streamState = StreamStateTracker()
+        # publish first, so other workers aren't waiting on this one's guilds to be notified
+        self.streamState.subscribe(WENT_LIVE, functools.partial(self.publishState, WENT_LIVE))
+        self.streamState.subscribe(WENT_OFFLINE, functools.partial(self.publishState, WENT_OFFLINE))
+        self.streamState.subscribe(WENT_LIVE, self.onWentLive)
+        self.streamState.subscribe(WENT_OFFLINE, self.onWentOffline)
+        self.streamState.subscribe(TITLE_CHANGED, self.onTitleChanged)
+
+        self.scheduler = PollScheduler(budget=POLL_BUDGET)
+
+        self.lease = bot.db.lease(POLL_LEASE)
+        self.leaseTask: typing.Union[asyncio.Task, None] = None
+        self.polling = False
+        """Is this process the one polling, and posting notifications"""
+
+        self.renders: typing.Dict[str, asyncio.Task] = {}
+        """Stream ID -> the shared render of its notification, for streams that are live"""
+
+        self.guildSemaphore = asyncio.Semaphore(GUILD_CONCURRENCY)
+
+        self.notifyBackoff: typing.Dict[typing.Tuple[int, str], typing.Tuple[int, float]] = {}
+        """(guild ID, stream ID) -> (failed attempts, when it may be retried), for notifications that failed to post"""
+
+        self.bot.cluster.onEvent(self.onClusterEvent)
+
+        self.eventSub: typing.Union[EventSubServer, None] = None
+        self.eventSubCallback: typing.Union[str, None] = None
+        self.eventSubSecret: typing.Union[str, None] = None
+        if USE_EVENTSUB:
+            # read now, as a missing credential is prompted for, which would block the event loop later
+            self.eventSubCallback = EVENTSUB_CALLBACK or utilities.getCredential("eventSubCallback")
+            self.eventSubSecret = utilities.getCredential("eventSubSecret")
+        self.subscribedIDs: typing.Set[str] = set()
+        """Streamers we hold every eventsub subscription for"""
+
+        self.notifyLatency: typing.Deque[float] = deque(maxlen=500)
+        """Seconds between a stream starting and its notification being posted, for recent notifications"""
+
         self.emoji = "📺"
 
     async def setup(self):
+        self.twitch.session = self.bot.createSession()
         try:
             log.debug("Authenticating Twitch")
-            self.twitch.authenticate_app([])
-        except TwitchAuthorizationException:
+            await self.twitch.authenticate()
+        except HelixAuthorizationException:
             log.critical("Failed to authenticate with twitch, abort")
             await self.bot.close()
         else:
             log.info("Authenticated with Twitch")
+        await self.configCache.load()
+        self.scheduler.load()
+        if USE_POLL_LEASE and not self.bot.cluster.enabled:
+            # standbys still need to hear about settings changed by the commands they receive
+            await self.bot.cluster.startEvents()
+            self.leaseTask = asyncio.ensure_future(self.lease.campaign(self.onElected, self.stopPolling))
+        else:
+            # a cluster's workers each poll their share of the streamers
+            await self.startPolling()
+
+    async def startPolling(self):
+        """Starts polling, and everything else only the polling process does"""
+        self.polling = True
+        await self.loadLiveStreams()
+        if self.bot.cluster.enabled:
+            await self.seedStreamState()
+        await self.archiveQueue.load()
+        self.archiveQueue.start()
+        if USE_EVENTSUB:
+            if self.bot.cluster.enabled and not EVENTSUB_CALLBACK:
+                # with a shared callback, each worker would delete the others' subscriptions as stale
+                log.error("Eventsub needs TWITCHING_EVENTSUB_CALLBACK set per worker when clustered, polling instead")
+            else:
+                await self.startEventSub()
         self.checkStatus.start()
 
+    async def stopPolling(self):
+        """Stops polling, ie when another process has taken over"""
+        self.polling = False
+        self.checkStatus.cancel()
+        await self.archiveQueue.stop()
+        if self.eventSub:
+            await self.eventSub.stop()
+            self.eventSub = None
+        # if we're elected again, start from what the database says rather than what we last saw
+        self.streamState.states.clear()
+        self.renders.clear()
+        log.warning("No longer polling, standing by")
+
+    async def onElected(self):
+        # the previous poller may have posted since our config was loaded
+        await self.configCache.load()
+        await self.startPolling()
+        log.info("Elected as the poller")
+
+    def cog_unload(self):
+        if self.leaseTask:
+            self.leaseTask.cancel()
+        self.checkStatus.cancel()
+        if self.eventSub:
+            self.bot.loop.create_task(self.eventSub.stop())
+        self.bot.loop.create_task(self.archiveQueue.stop())
+        self.bot.loop.create_task(self.scheduler.persister.flush())
+        self.bot.loop.create_task(self.twitch.close())
+
     def check_perms(self, ctx):
         """Checks if user can use these commands"""
         if ctx.author.id == ctx.guild.owner.id:
@@ -67,178 +201,535 @@ class Twitch(commands.Cog):
             return True
         return False
 
+    @staticmethod
+    def renderArchived(msgObj: dict) -> typing.Union[discord.Embed, None]:
+        """Builds the archived version of a notification from its stored state"""
+        if msgObj.get('displayName') is None:
+            return None
+        embed = discord.Embed(colour=discord.Colour.dark_grey())
+        embed.description = f"{msgObj['title']}\n" \
+                            f"[View Channel](https://twitch.tv/{msgObj['twitchChannel']})"
+        embed.set_author(name=f"{msgObj['displayName']} was live",
+                         icon_url=msgObj['avatarURL'])
+        return embed
+
+    async def archiveMessage(self, msgObj: dict):
+        """Edits a posted notification into its archived form"""
+        channel = self.bot.get_channel(int(msgObj['channelID']))
+        if not channel:
+            return
+        messageID = int(msgObj['messageID'])
+
+        embed = self.renderArchived(msgObj)
+        if embed is not None:
+            # we know everything we need, so edit without fetching the message
+            await self.bot.getPartialMessage(messageID, channel).edit(embed=embed)
+            return
+
+        # posted before archive state was stored, so it has to be rebuilt from the message itself
+        message: discord.Message = await self.bot.getMessage(messageID, channel)
+        if message:
+            originEmbed: discord.Embed = message.embeds[0]
+            embed = discord.Embed(colour=discord.Colour.dark_grey())
+            author = originEmbed.author.__dict__
+            embed.description = originEmbed.description.replace("Tune In", "View Channel")
+            embed.set_author(name=author['name'].replace("is live", "was live"),
+                             icon_url=author['icon_url'])
+            await message.edit(embed=embed)
+
+    async def loadLiveStreams(self):
+        """Loads which streams have notifications waiting to be archived"""
+        self.liveStreams = {}
+        async for row in self.bot.db.fetch_iter(
+                "SELECT DISTINCT twitchChannel, streamID FROM twitching.postedMessages WHERE archiving = 0"
+        ):
+            self.liveStreams.setdefault(row['twitchChannel'], set()).add(row['streamID'])
+        log.debug(f"{len(self.liveStreams)} streamers have unarchived notifications")
+
     async def archiveTwitchChannel(self, twitchChannel: str):
-        """Checks if messages should be archived, and if so, archives them"""
-        data = await self.bot.db.execute(
-            f"SELECT * FROM twitching.streams WHERE twitchChannel = '{twitchChannel}'",
-            getOne=True
+        """Checks if messages should be archived, and if so, queues them to be archived"""
+        if twitchChannel not in self.liveStreams:
+            # nothing was posted for this streamer, so there is nothing to archive
+            return
+        # a newer stream may be stored while we wait, that one isn't ours to archive or forget
+        streamIDs = list(self.liveStreams[twitchChannel])
+        postedMessages = await self.bot.db.execute(
+            "SELECT * FROM twitching.postedMessages WHERE twitchChannel = %s AND archiving = 0 "
+            f"AND streamID IN ({', '.join(['%s'] * len(streamIDs))})",
+            (twitchChannel, *streamIDs)
         )
-        if data is not None:
+        if postedMessages is None:
+            # the query failed, keep them so the next tick tries again
+            return
+        # other workers archive the messages in guilds they hold
+        postedMessages = [row for row in postedMessages if self.ownsMessage(row)]
+        if postedMessages:
             # user is no longer streaming, and as data is still here, we need to archive
-            if data['postedMessages'] is None:
-                return None
-
-            # posted messages stored like this:
-            # [channelID, messageID]
-            log.debug(f"{twitchChannel} has likely stopped streaming, archiving")
-            for msgObj in json.loads(data['postedMessages']):
-                try:
-                    channel = self.bot.get_channel(int(msgObj[0]))
-                    if channel:
-                        message: discord.Message = await self.bot.getMessage(int(msgObj[1]), channel)
-                        if message:
-                            originEmbed: discord.Embed = message.embeds[0]
-                            embed = discord.Embed(colour=discord.Colour.dark_grey())
-                            author = originEmbed.author.__dict__
-                            embed.description = originEmbed.description.replace("Tune In", "View Channel")
-                            embed.set_author(name=author['name'].replace("is live", "was live"),
-                                             icon_url=author['icon_url'])
-                            await message.edit(embed=embed)
-                except Exception as ex:
-                    log.error('Ignoring exception in twitch: {}'.format(
-                        "".join(traceback.format_exception(type(ex), ex,
-                                                           ex.__traceback__))))
-
-            # i dont know if twitch re-uses streamIDs but im going to be careful
-            await self.bot.db.execute(
-                f"DELETE FROM twitching.streams WHERE streamID = '{data['streamID']}'",
-                getOne=True
-            )
-
-    async def storeMessage(self, streamID: str, message: discord.Message, twitchChannel: str):
-        """Stores posted stream notifications so they can be archived later"""
-        data = await self.bot.db.execute(
-            f"SELECT * FROM twitching.streams WHERE streamID='{streamID}'",
-            getOne=True
-        )
-        if data is not None:
-            postedMessages = json.loads(data['postedMessages']) if data['postedMessages'] is not None else []
+            log.debug(f"{twitchChannel} has likely stopped streaming, archiving {len(postedMessages)} messages")
+            await self.archiveQueue.enqueue(postedMessages)
+        remaining = self.liveStreams.get(twitchChannel, set()).difference(streamIDs)
+        if remaining:
+            self.liveStreams[twitchChannel] = remaining
         else:
-            postedMessages = []
-
-        # prevent duplication, shouldn't happen, but i wanna be sure
-        data = [message.channel.id, message.id]
-        if data not in postedMessages:
-            postedMessages.append(data)
-
-        postedMessages = await self.bot.db.escape(json.dumps(postedMessages))
+            self.liveStreams.pop(twitchChannel, None)
 
+    async def storeMessage(self, message: discord.Message, userData: dict, streamData: dict):
+        """Stores posted stream notifications, and what is needed to archive them later"""
         await self.bot.db.execute(
-            f"INSERT INTO twitching.streams (streamID, postedMessages, twitchChannel) "
-            f"VALUES ('{streamID}', '{postedMessages}', '{twitchChannel}') "
-            f"ON DUPLICATE KEY UPDATE postedMessages = '{postedMessages}'"
+            "INSERT IGNORE INTO twitching.postedMessages "
+            "(messageID, channelID, streamID, twitchChannel, displayName, avatarURL, title) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+            (str(message.id), str(message.channel.id), streamData['id'], userData['login'],
+             userData['display_name'], userData['profile_image_url'], streamData['title'])
         )
+        # only once stored, so an archive already querying either sees the row or leaves this stream be
+        self.liveStreams.setdefault(userData['login'], set()).add(streamData['id'])
+
+    async def pollStreamers(self, userIDs: typing.Iterable[str],
+                            priority: Priority = Priority.BACKGROUND) -> typing.Tuple[dict, dict]:
+        """Fetches user and stream data for every given user in batches
+
+        :return: a dict of userID -> userData, and a dict of userID -> streamData for live users"""
+        userIDs = list(userIDs)
+        batches = [userIDs[i:i + BATCH_SIZE] for i in range(0, len(userIDs), BATCH_SIZE)]
+        results = await asyncio.gather(
+            *[self.twitch.get_users(user_ids=batch, priority=priority) for batch in batches],
+            *[self.twitch.get_streams(user_id=batch, first=BATCH_SIZE, priority=priority) for batch in batches]
+        )
+        users = {}
+        streams = {}
+        for userData in results[:len(batches)]:
+            users.update({d['id']: d for d in userData['data']})
+        for streamData in results[len(batches):]:
+            streams.update({d['user_id']: d for d in streamData['data']})
+        return users, streams
+
+    def trackedStreamers(self) -> typing.Set[str]:
+        """Gets every streamer this worker polls, those tracked by a guild that wants notifications
+
+        When clustered, that is every guild's streamers, not just this worker's guilds, that hash to this worker"""
+        cluster = self.bot.cluster
+        tracked = set()
+        for config in self.configCache:
+            if config.active and (cluster.enabled or self.bot.get_guild(config.guildID) is not None):
+                tracked.update(config.twitchChannels)
+        return {userID for userID in tracked if cluster.owns(userID)}
+
+    def ownsMessage(self, row: dict) -> bool:
+        """Is a posted notification in a guild this worker holds"""
+        return not self.bot.cluster.enabled or self.bot.get_channel(int(row['channelID'])) is not None
+
+    async def publishState(self, event: str, state: StreamState):
+        """Sends a streamer's state change to the other workers, if this worker is the one polling them"""
+        if not self.bot.cluster.enabled or not self.bot.cluster.owns(state.userID):
+            return
+        if event == WENT_OFFLINE and state.streamID is None:
+            # seen offline for the first time, ie on startup or after the ring moved, and no worker
+            # told us they were live, so there is nothing for the others to end
+            return
+        await self.bot.cluster.publish(event, state.userID, {
+            "userData": state.userData,
+            "streamData": state.streamData,
+            "firstSeen": state.firstSeen
+        })
+
+    async def seedStreamState(self):
+        """Learns which streams other workers have already seen go live, as they won't be published again"""
+        seeded = 0
+        for event, userID, payload in await self.bot.cluster.latestEvents((WENT_LIVE, WENT_OFFLINE)):
+            if event != WENT_LIVE or self.bot.cluster.owns(userID) or self.streamState.get(userID) is not None:
+                # we poll them ourselves, or have already heard something newer
+                continue
+            # they may have been live for a while, so this isn't a transition to measure
+            await self.streamState.setLive(userID, payload['userData'], payload['streamData'], firstSeen=True)
+            seeded += 1
+        if seeded:
+            log.info(f"Learnt of {seeded} live streams from other workers")
+
+    async def configChanged(self, guildID: int):
+        """Tells the other workers a guild's settings changed"""
+        await self.bot.cluster.publish(CONFIG_CHANGED, None, {"guildID": str(guildID)})
+
+    async def onClusterEvent(self, event: str, userID: typing.Union[str, None], payload: dict):
+        """Applies an event published by another worker"""
+        if event == CONFIG_CHANGED:
+            await self.configCache.reloadGuild(int(payload['guildID']))
+            guild = self.bot.get_guild(int(payload['guildID']))
+            if guild is not None:
+                await self.catchUpGuild(guild)
+        elif event == WENT_LIVE:
+            await self.streamState.setLive(userID, payload['userData'], payload['streamData'],
+                                           payload.get('firstSeen'))
+        elif event == WENT_OFFLINE:
+            await self.streamState.setOffline(userID, payload['userData'])
 
     @tasks.loop(minutes=1)
     async def checkStatus(self):
         try:
-            postedStreams = set()
-            for guild in self.bot.guilds:
-                seenIDs = set()
-                guildData = await self.bot.db.execute(
-                    f"SELECT * FROM twitching.twitch WHERE guildID = '{guild.id}'",
-                    getOne=True
-                )
-                if guildData is None:
-                    continue
-
-                if guildData['postChannel'] is not None and guildData['twitchChannel'] is not None:
-                    twitchChannels: set = set(json.loads(guildData['twitchChannel']))
-                    postedStreams: set = \
-                        set(json.loads(guildData['postedStreamIDs'])) if guildData[
-                                                                             'postedStreamIDs'] is not None else set()
-
-                    # obtain all channels for this guild in one api call
-                    # this limits it to 100 channels per guild, but if someone is trying to track more than that
-                    # they are almost certainly trying to break the bot
-                    done, pending = await asyncio.wait(
-                        fs={
-                            self.bot.loop.run_in_executor(
-                                self.executor,
-                                functools.partial(self.twitch.get_users, user_ids=list(twitchChannels))
-                            )
-                        }
-                    )
-                    allUserData = [task.result() for task in done][0]
-
-                    for tChannel in twitchChannels:
-                        userData = [d for d in allUserData['data'] if d['id'] == tChannel]
-                        done, pending = await asyncio.wait(
-                            fs={
-                                self.bot.loop.run_in_executor(
-                                    self.executor,
-                                    functools.partial(self.twitch.get_streams, user_id=tChannel)
-                                )
-                            }
-                        )
-                        streamData = [task.result() for task in done][0]
-                        userData = userData[0] if userData else None
-                        streamData = streamData['data'] if streamData else None
-
-                        if userData is None:
-                            # user is no longer on twitch
-                            continue
-
-                        if not streamData:
-                            # User is not streaming check if they were, and archive
-                            await self.archiveTwitchChannel(userData['login'])
-                            continue
-
-                        streamData = streamData[0]
-                        seenIDs.add(streamData['id'])
-
-                        # User is streaming
-                        if streamData['id'] not in postedStreams:
-                            log.info(f"{userData['display_name']} is live, and stream is new, posting")
-                            channel = guild.get_channel(int(guildData['postChannel']))
-                            if channel:
-                                thumbnailURL = streamData['thumbnail_url']
-                                thumbnailURL = thumbnailURL.replace("{width}", "1280")
-                                thumbnailURL = thumbnailURL.replace("{height}", "720")
-                                colour = await utilities.getDominantColour(self.bot, userData['profile_image_url'])
-
-                                embed = discord.Embed(colour=colour)
-                                embed.description = f"{streamData['title']}\n" \
-                                                    f"[Tune In](https://twitch.tv/{userData['login']})"
-                                embed.set_author(name=f"{userData['display_name']} is live",
-                                                 icon_url=userData['profile_image_url'])
-                                embed.set_image(url=thumbnailURL + f"?{round(time.time())}")
-                                embed.url = f"https://twitch.tv/{userData['login']}"
-
-                                # if we're supposed to be mentioning a role
-                                if guildData['mentions']:
-                                    mentions: dict = json.loads(guildData['mentions'])
-                                    if tChannel in mentions or "all" in mentions:
-                                        # user has probably set a channel to mention
-                                        role: str = mentions[tChannel] if tChannel in mentions else mentions['all']
-                                        role: discord.Role = await guild.get_role(int(role))
-                                        if role:
-                                            embed.description = f"{embed.description}\n{role.mention}"
-
-                                msg = await channel.send(embed=embed)
-
-                                await self.storeMessage(streamData['id'], msg, userData['login'])
-
-                                postedStreams.add(streamData['id'])
-                        else:
-                            log.spam(f"{userData['display_name']} is live, but stream is old, not posting")
-                # remove ended streams
-                for s in postedStreams.copy():
-                    if s not in seenIDs:
-                        # this stream is over, remove it
-                        postedStreams.remove(s)
-
-                # prevent repeated notifs
-                postedStreams = await self.bot.db.escape(json.dumps(postedStreams, cls=SetEncoder))
-                await self.bot.db.execute(
-                    f"INSERT INTO twitching.twitch (guildID, postedStreamIDs) "
-                    f"VALUES ('{guild.id}', '{postedStreams}') ON DUPLICATE KEY UPDATE "
-                    f"postedStreamIDs = '{postedStreams}'"
-                )
+            # each streamer is only requested once per cycle, no matter how many guilds track them
+            trackedIDs = self.trackedStreamers()
+            for userID in set(self.scheduler.tiers) - trackedIDs:
+                self.scheduler.forget(userID)
+            # when clustered, other workers keep this worker's view of the streamers they poll up to date
+            for userID in set(self.streamState.states) - set(self.configCache.subscribers):
+                state = self.streamState.get(userID)
+                if state.streamID:
+                    self.renders.pop(state.streamID, None)
+                self.streamState.forget(userID)
+            if not trackedIDs:
+                return
+
+            if self.eventSub:
+                await self.syncSubscriptions(trackedIDs)
+
+            await self.retryNotifications()
+
+            # retry archiving anyone whose messages couldn't be fetched when they went offline
+            for state in list(self.streamState.states.values()):
+                if not state.live and state.login in self.liveStreams:
+                    await self.archiveTwitchChannel(state.login)
+
+            dueIDs = self.scheduler.due(trackedIDs, self.isLive, self.checkStatus.minutes * 60)
+            if not dueIDs:
+                return
+            allUserData, allStreamData = await self.pollStreamers(dueIDs)
+            events = await self.streamState.update(allUserData, allStreamData)
+            self.scheduler.polled(dueIDs, set(allStreamData))
+
+            log.debug(f"Polled {len(dueIDs)}/{len(trackedIDs)} streamers, {len(events)} state changes. "
+                      f"Tiers: {self.scheduler.report()}, ~{self.scheduler.requestsPerMinute} requests/min. "
+                      f"Helix: {self.twitch.limiter.stats}. Notify latency: {self.latencySummary()}")
         except Exception as ex:
             log.error('Ignoring exception in twitch: {}'.format(
                 "".join(traceback.format_exception(type(ex), ex,
                                                    ex.__traceback__))))
+        finally:
+            # posts are claimed as they happen, this writes the streams that ended
+            await self.configCache.flush()
+
+    def isLive(self, userID: str) -> bool:
+        state = self.streamState.get(userID)
+        return state is not None and state.live
+
+    async def startEventSub(self):
+        """Starts receiving eventsub webhooks, and slows polling down to a reconciliation pass"""
+        self.eventSub = EventSubServer(secret=self.eventSubSecret,
+                                       host=EVENTSUB_HOST, port=EVENTSUB_PORT)
+        self.eventSub.on(STREAM_ONLINE, self.onStreamOnline)
+        self.eventSub.on(STREAM_OFFLINE, self.onStreamOffline)
+        self.eventSub.onRevoked(self.onSubscriptionRevoked)
+        try:
+            await self.eventSub.start()
+        except OSError as e:
+            # ie another worker on this host already has the port
+            log.error(f"Failed to listen for eventsub on port {EVENTSUB_PORT}, polling instead: {e}")
+            self.eventSub = None
+            return
+        self.checkStatus.change_interval(minutes=RECONCILE_INTERVAL)
+
+    async def syncSubscriptions(self, trackedIDs: typing.Set[str]):
+        """Subscribes to every tracked streamer, and unsubscribes from any that are no longer tracked
+
+        Only subscriptions on this worker's callback are considered, so when clustered, a streamer that moved to
+        another worker is unsubscribed here and subscribed on theirs"""
+        existing = await self.twitch.get_eventsub_subscriptions()
+        held: typing.Dict[str, typing.Set[str]] = {}
+        stale = []
+        for sub in existing:
+            userID = sub['condition'].get('broadcaster_user_id')
+            if sub['transport'].get('callback') != self.eventSubCallback:
+                continue
+            if userID not in trackedIDs or sub['status'] not in ("enabled", "webhook_callback_verification_pending"):
+                stale.append(sub['id'])
+            else:
+                held.setdefault(userID, set()).add(sub['type'])
+
+        await asyncio.gather(*[self.twitch.delete_eventsub_subscription(subID) for subID in stale])
+        self.subscribedIDs = {userID for userID, types in held.items() if types.issuperset(EVENTSUB_TYPES)}
+        missing = [(userID, subType) for userID in trackedIDs for subType in EVENTSUB_TYPES
+                   if subType not in held.get(userID, ())]
+        if stale or missing:
+            log.info(f"Eventsub: removing {len(stale)} stale subscriptions, creating {len(missing)}")
+        await self.subscribe(missing)
+
+    async def subscribe(self, wanted: typing.List[typing.Tuple[str, str]]):
+        """Creates eventsub subscriptions for (userID, type) pairs"""
+        results = await asyncio.gather(
+            *[self.twitch.create_eventsub_subscription(subType, {"broadcaster_user_id": userID},
+                                                       self.eventSubCallback, self.eventSub.secret)
+              for userID, subType in wanted],
+            return_exceptions=True
+        )
+        failed = set()
+        for (userID, subType), result in zip(wanted, results):
+            if isinstance(result, Exception):
+                failed.add(userID)
+                log.error(f"Failed to subscribe to {subType} for {userID}: {result}")
+        self.subscribedIDs.update({userID for userID, _ in wanted} - failed)
+
+    async def onStreamOnline(self, event: dict):
+        """Handles a stream.online notification"""
+        userID = event['broadcaster_user_id']
+        if not self.configCache.guildsTracking(userID) or not self.bot.cluster.owns(userID):
+            return
+        users, streams = await self.pollStreamers([userID], priority=Priority.INTERACTIVE)
+        userData = users.get(userID)
+        if userData is None:
+            return
+        streamData = streams.get(userID)
+        if streamData is None or streamData['id'] != event['id']:
+            # helix can lag behind eventsub, so fill in what the notification told us
+            streamData = {
+                "id": event['id'],
+                "user_id": userID,
+                "user_login": event['broadcaster_user_login'],
+                "started_at": event['started_at'],
+                "title": "",
+                "thumbnail_url": f"https://static-cdn.jtvnw.net/previews-ttv/"
+                                 f"live_user_{event['broadcaster_user_login']}-{{width}}x{{height}}.jpg"
+            }
+        await self.streamState.setLive(userID, userData, streamData)
+
+    async def onStreamOffline(self, event: dict):
+        """Handles a stream.offline notification"""
+        userID = event['broadcaster_user_id']
+        if not self.configCache.guildsTracking(userID) or not self.bot.cluster.owns(userID):
+            return
+        await self.streamState.setOffline(userID, {
+            "id": userID,
+            "login": event['broadcaster_user_login'],
+            "display_name": event['broadcaster_user_name']
+        })
+
+    async def onSubscriptionRevoked(self, subscription: dict):
+        # resubscribed by the next reconciliation, if they're still tracked and it's possible
+        self.subscribedIDs.discard(subscription['condition'].get('broadcaster_user_id'))
+
+    def guildsTracking(self, userID: str) -> typing.List[typing.Tuple[discord.Guild, GuildConfig]]:
+        """Gets every guild that wants notifications for a streamer"""
+        guilds = []
+        for guildID in self.configCache.guildsTracking(userID):
+            guild = self.bot.get_guild(guildID)
+            config = self.configCache.get(guildID)
+            if guild is not None and config.active:
+                guilds.append((guild, config))
+        return guilds
+
+    async def onWentLive(self, state: StreamState):
+        """Notifies every guild tracking a streamer that just went live"""
+        log.info(f"{state.userData['display_name']} is live")
+        # a streamer seen for the first time, ie on startup or when added, may have been live for hours
+        await asyncio.gather(
+            *[self.notifyGuildSafe(guild, config, state, measureLatency=not state.firstSeen)
+              for guild, config in self.guildsTracking(state.userID)]
+        )
+
+    async def onWentOffline(self, state: StreamState):
+        """Forgets a streamer's ended streams, and archives their notifications"""
+        endedIDs = set(self.liveStreams.get(state.login, ()))
+        if state.streamID:
+            endedIDs.add(state.streamID)
+            self.renders.pop(state.streamID, None)
+
+        for guildID in self.configCache.guildsTracking(state.userID):
+            config = self.configCache.get(guildID)
+            if config.postedStreamIDs & endedIDs:
+                self.configCache.endStreams(guildID, endedIDs)
+
+        await self.archiveTwitchChannel(state.login)
+
+    async def onTitleChanged(self, state: StreamState):
+        log.debug(f"{state.login} changed their title to {state.title}")
+        # later posts, ie catching a guild up, should show the new title
+        self.renders.pop(state.streamID, None)
+
+    async def catchUpGuild(self, guild: discord.Guild):
+        """Notifies a guild of any streams that are already live, ie after it adds a streamer"""
+        config = self.configCache.get(guild.id)
+        if not self.polling or config is None or not config.active:
+            return
+        for userID in config.twitchChannels.copy():
+            state = self.streamState.get(userID)
+            if state is not None and state.live:
+                await self.notifyGuildSafe(guild, config, state)
+
+    async def retryNotifications(self):
+        """Notifies any guild still missing a live stream, ie because posting failed when it went live"""
+        liveIDs = {state.streamID for state in self.streamState.states.values() if state.live}
+        self.notifyBackoff = {key: backoff for key, backoff in self.notifyBackoff.items() if key[1] in liveIDs}
+
+        now = time.monotonic()
+        retries = []
+        for state in list(self.streamState.states.values()):
+            if not state.live:
+                continue
+            for guild, config in self.guildsTracking(state.userID):
+                if state.streamID in config.postedStreamIDs:
+                    continue
+                backoff = self.notifyBackoff.get((guild.id, state.streamID))
+                if backoff is None or backoff[1] <= now:
+                    retries.append(self.notifyGuildSafe(guild, config, state))
+        if retries:
+            log.debug(f"Retrying {len(retries)} notifications")
+            await asyncio.gather(*retries)
+
+    async def notifyGuildSafe(self, guild: discord.Guild, config: GuildConfig, state: StreamState,
+                              measureLatency: bool = False):
+        """Notifies a guild within the concurrency limit, so one failing guild can't affect the others"""
+        async with self.guildSemaphore:
+            key = (guild.id, state.streamID)
+            try:
+                await self.notifyGuild(guild, config, state, measureLatency)
+            except Exception as ex:
+                log.error('Ignoring exception in twitch for guild {}: {}'.format(
+                    guild.id, "".join(traceback.format_exception(type(ex), ex, ex.__traceback__))))
+                attempts = self.notifyBackoff.get(key, (0, 0))[0] + 1
+                delay = min(MAX_NOTIFY_RETRY_DELAY, NOTIFY_RETRY_DELAY * 2 ** (attempts - 1))
+                self.notifyBackoff[key] = (attempts, time.monotonic() + delay)
+            else:
+                self.notifyBackoff.pop(key, None)
+
+    def recordLatency(self, streamData: dict):
+        """Records how long after a stream started its notification was posted"""
+        try:
+            startedAt = datetime.strptime(streamData['started_at'], "%Y-%m-%dT%H:%M:%SZ")
+        except (KeyError, ValueError):
+            return
+        startedAt = startedAt.replace(tzinfo=timezone.utc)
+        self.notifyLatency.append((datetime.now(timezone.utc) - startedAt).total_seconds())
+
+    def latencySummary(self) -> str:
+        """Summarises recent notification latency"""
+        if not self.notifyLatency:
+            return "no data"
+        ordered = sorted(self.notifyLatency)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return f"p50 {statistics.median(ordered):.1f}s, p95 {p95:.1f}s, max {ordered[-1]:.1f}s"
+
+    async def getColour(self, imageURL: str) -> typing.Union[int, discord.Colour]:
+        """Gets the dominant colour of a profile image, falling back to DEFAULT_COLOUR rather than failing"""
+        try:
+            colour = await utilities.getDominantColour(self.bot, imageURL)
+        except Exception as e:
+            log.warning(f"Failed to get the dominant colour of {imageURL}: {e!r}")
+            return DEFAULT_COLOUR
+        return colour if colour is not None else DEFAULT_COLOUR
+
+    async def renderNotification(self, userData: dict, streamData: dict) -> discord.Embed:
+        """Builds the live notification embed for a stream, without any guild specific content or its thumbnail"""
+        embed = discord.Embed(colour=await self.getColour(userData['profile_image_url']))
+        embed.description = f"{streamData['title']}\n" \
+                            f"[Tune In](https://twitch.tv/{userData['login']})"
+        embed.set_author(name=f"{userData['display_name']} is live",
+                         icon_url=userData['profile_image_url'])
+        embed.url = f"https://twitch.tv/{userData['login']}"
+        return embed
+
+    @staticmethod
+    def thumbnailURL(streamData: dict) -> str:
+        """Gets a stream's thumbnail, with a cache buster so discord fetches it as it is now"""
+        thumbnailURL = streamData['thumbnail_url']
+        thumbnailURL = thumbnailURL.replace("{width}", "1280")
+        thumbnailURL = thumbnailURL.replace("{height}", "720")
+        return thumbnailURL + f"?{round(time.time())}"
+
+    def getRender(self, state: StreamState) -> asyncio.Task:
+        """Gets the shared render of a live stream's notification, so it is only built once"""
+        if state.streamID not in self.renders:
+            task = asyncio.ensure_future(self.renderNotification(state.userData, state.streamData))
+            task.add_done_callback(functools.partial(self._renderDone, state.streamID))
+            self.renders[state.streamID] = task
+        return self.renders[state.streamID]
+
+    def _renderDone(self, streamID: str, task: asyncio.Task):
+        """Forgets a failed render, so the next post tries again rather than reusing the failure"""
+        if not task.cancelled() and task.exception() is None:
+            return
+        if self.renders.get(streamID) is task:
+            del self.renders[streamID]
+
+    async def notifyGuild(self, guild: discord.Guild, config: GuildConfig, state: StreamState,
+                          measureLatency: bool = False):
+        """Posts a notification for a live stream to a guild, unless it already has been
+
+        :param measureLatency: Record how long after the stream started this was posted, only meaningful
+        when posting because the stream just went live, rather than catching a guild up"""
+        userData, streamData = state.userData, state.streamData
+        if streamData['id'] in config.postedStreamIDs:
+            log.spam(f"{userData['display_name']} is live, but stream is old, not posting")
+            return
+
+        channel = guild.get_channel(config.postChannel)
+        if not channel:
+            return
+        log.info(f"{userData['display_name']} is live, and stream is new, posting in {guild.id}")
+        render: discord.Embed = await self.getRender(state)
+        # copy, so the thumbnail and any mention don't leak into other guilds' notifications
+        embed = discord.Embed.from_dict(render.to_dict())
+        embed.set_image(url=self.thumbnailURL(streamData))
+
+        # if we're supposed to be mentioning a role
+        if config.mentions:
+            mentions: dict = config.mentions
+            if state.userID in mentions or "all" in mentions:
+                # user has probably set a channel to mention
+                role: str = mentions[state.userID] if state.userID in mentions else mentions['all']
+                role: discord.Role = guild.get_role(int(role))
+                if role:
+                    embed.description = f"{embed.description}\n{role.mention}"
+
+        # prevent repeated notifs, even from another process or a restart, before anything is sent
+        if not await self.configCache.claimStream(guild.id, streamData['id']):
+            log.debug(f"{userData['display_name']}'s stream was already claimed in {guild.id}, not posting")
+            return
+        try:
+            msg = await channel.send(embed=embed)
+        except (discord.Forbidden, discord.NotFound) as e:
+            # retrying won't help until the guild fixes it, so keep the claim and give up on this stream
+            log.warning(f"Can't post {userData['display_name']}'s stream in {guild.id}, giving up: {e}")
+            return
+        except Exception:
+            # nothing was posted, so a later retry can have it
+            await self.configCache.releaseStream(guild.id, streamData['id'])
+            raise
+        if measureLatency:
+            self.recordLatency(streamData)
+
+        await self.storeMessage(msg, userData, streamData)
+
+    @commands.command(name="stats", brief="Shows polling statistics")
+    async def cmdStats(self, ctx: commands.Context):
+        if await self.bot.is_owner(ctx.author):
+            limiter = self.twitch.limiter
+            embed = discord.Embed(title="Twitch Stats", colour=discord.Colour.blurple())
+            embed.add_field(name="Helix Budget", value=f"{limiter.remaining}/{limiter.limit}")
+            embed.add_field(name="Helix Pending", value=str(limiter.pending))
+            for name, value in limiter.stats.items():
+                embed.add_field(name=f"Helix {name.title()}", value=str(value))
+            for name, value in utilities.colourCache.stats.items():
+                embed.add_field(name=f"Colour Cache {name.title()}", value=str(value))
+            for tier, summary in self.scheduler.report().items():
+                embed.add_field(name=f"Poll Tier {tier.title()}", value=summary)
+            embed.add_field(name="Poll Budget",
+                            value=f"~{self.scheduler.requestsPerMinute}/{self.scheduler.budget} requests/min, "
+                                  f"stretch {self.scheduler.stretch:.2f}x")
+            embed.add_field(name="Polling", value="Yes" if self.polling else "No, standing by")
+            if self.bot.cluster.enabled:
+                embed.add_field(name="Worker", value=f"{self.bot.cluster.workerID} "
+                                                     f"of {len(self.bot.cluster.workers)}")
+                for name, value in self.bot.cluster.stats.items():
+                    embed.add_field(name=f"Cluster {name.title()}", value=str(value))
+            embed.add_field(name="Tracked Streamers", value=str(len(self.streamState.states)))
+            embed.add_field(name="Live Streamers", value=str(self.streamState.liveCount))
+            if self.eventSub:
+                for name, value in self.eventSub.stats.items():
+                    embed.add_field(name=f"EventSub {name.title()}", value=str(value))
+                embed.add_field(name="EventSub Subscribed", value=str(len(self.subscribedIDs)))
+            embed.add_field(name="Archive Pending", value=str(self.archiveQueue.pending))
+            embed.add_field(name="Archived", value=str(self.archiveQueue.archived))
+            embed.add_field(name="Archive Failures", value=str(self.archiveQueue.failed))
+            embed.add_field(name="Notify Latency", value=self.latencySummary(), inline=False)
+            await ctx.send(embed=embed)
 
     @cog_ext.cog_subcommand(base="twitch", subcommand_group="channel", name="set",
                             description="Set the channel to post live notifications to",
@@ -285,15 +776,13 @@ class Twitch(commands.Cog):
                 )
                 return await ctx.send(embed=embed)
 
-        await self.bot.db.execute(
-            f"INSERT INTO twitching.twitch (guildID, postChannel) "
-            f"VALUES ('{ctx.guild_id}', '{channel.id}') "
-            f"ON DUPLICATE KEY UPDATE postChannel = '{channel.id}'"
-        )
+        await self.configCache.setPostChannel(ctx.guild_id, channel.id)
+        await self.configChanged(ctx.guild_id)
 
         embed = discord.Embed(title=f"Posting notifications in {channel.name}",
                               colour=discord.Colour.blurple())
         await ctx.send(embed=embed)
+        await self.catchUpGuild(ctx.guild)
 
     @cog_ext.cog_subcommand(base="twitch", subcommand_group="channel", name="clear",
                             description="Stop posting updates",
@@ -303,11 +792,8 @@ class Twitch(commands.Cog):
         if not self.check_perms(ctx):
             return await ctx.send("Sorry you need manage_messages to use this command", hidden=True)
 
-        await self.bot.db.execute(
-            f"INSERT INTO twitching.twitch (guildID, postChannel) "
-            f"VALUES ('{ctx.guild_id}', NULL) "
-            f"ON DUPLICATE KEY UPDATE postChannel = NULL"
-        )
+        await self.configCache.setPostChannel(ctx.guild_id, None)
+        await self.configChanged(ctx.guild_id)
 
         embed = discord.Embed(title=f"Stopped twitch updates",
                               colour=discord.Colour.blurple())
@@ -332,11 +818,7 @@ class Twitch(commands.Cog):
         embed = discord.Embed(title="Adding Streamer", colour=discord.Colour.orange())
 
         # try and find streamer
-        data = await self.bot.loop.run_in_executor(
-            self.executor,
-            functools.partial(
-                self.twitch.get_users,
-                logins=streamerName))
+        data = await self.twitch.get_users(logins=streamerName, priority=Priority.INTERACTIVE)
         streamer = data['data'][0] if data['data'] else None
         if not streamer:
             embed.colour = discord.Colour.red()
@@ -350,28 +832,20 @@ class Twitch(commands.Cog):
         embed.url = f"https://twitch.tv/{streamer['login']}"
         msg = await ctx.send(embed=embed)
 
-        # write to db
-        dbData = await self.bot.db.execute(
-            f"SELECT * FROM twitching.twitch WHERE guildID = '{ctx.guild_id}'",
-            getOne=True
-        )
-        try:
-            existingStreamers = set() if not dbData else set(json.loads(dbData['twitchChannel']))
-        except Exception as e:
-            log.error(e)
-            existingStreamers = set()
-
-        existingStreamers.add(streamer['id'])
-
-        existingStreamers = await self.bot.db.escape(json.dumps(existingStreamers, cls=SetEncoder))
-        await self.bot.db.execute(
-            f"INSERT INTO twitching.twitch (guildID, postChannel, twitchChannel) "
-            f"VALUES ('{ctx.guild_id}', NULL, '{existingStreamers}') "
-            f"ON DUPLICATE KEY UPDATE twitchChannel = '{existingStreamers}'"
-        )
+        await self.configCache.addStreamer(ctx.guild_id, streamer['id'])
+        await self.configChanged(ctx.guild_id)
         embed.title = f"Added {streamer['display_name']} to watch list"
         embed.colour = discord.Colour.blurple()
         await msg.edit(embed=embed)
+        owned = self.bot.cluster.owns(streamer['id'])
+        if self.eventSub and owned and streamer['id'] not in self.subscribedIDs:
+            await self.subscribe([(streamer['id'], subType) for subType in EVENTSUB_TYPES])
+        if self.polling and owned and self.streamState.get(streamer['id']) is None:
+            # not tracked by anyone yet, so find out if they're live now rather than next poll
+            users, streams = await self.pollStreamers([streamer['id']], Priority.INTERACTIVE)
+            await self.streamState.update(users, streams)
+            self.scheduler.polled([streamer['id']], set(streams))
+        await self.catchUpGuild(ctx.guild)
 
     @cog_ext.cog_subcommand(base="twitch", subcommand_group="streamer", name="remove",
                             description="Remove a streamer from the watched list",
@@ -392,11 +866,7 @@ class Twitch(commands.Cog):
         embed = discord.Embed(title="Removing Streamer", colour=discord.Colour.orange())
 
         # try and find streamer
-        data = await self.bot.loop.run_in_executor(
-            self.executor,
-            functools.partial(
-                self.twitch.get_users,
-                logins=streamerName))
+        data = await self.twitch.get_users(logins=streamerName, priority=Priority.INTERACTIVE)
         streamer = data['data'][0] if data['data'] else None
         if not streamer:
             embed.colour = discord.Colour.red()
@@ -410,24 +880,8 @@ class Twitch(commands.Cog):
         embed.url = f"https://twitch.tv/{streamer['login']}"
         msg = await ctx.send(embed=embed)
 
-        # write to db
-        dbData = await self.bot.db.execute(
-            f"SELECT * FROM twitching.twitch WHERE guildID = '{ctx.guild_id}'",
-            getOne=True
-        )
-        try:
-            existingStreamers = set() if not dbData else set(json.loads(dbData['twitchChannel']))
-        except Exception as e:
-            log.error(e)
-            existingStreamers = set()
-        existingStreamers.remove(streamer['id'])
-
-        existingStreamers = await self.bot.db.escape(json.dumps(existingStreamers, cls=SetEncoder))
-        await self.bot.db.execute(
-            f"INSERT INTO twitching.twitch (guildID, postChannel, twitchChannel) "
-            f"VALUES ('{ctx.guild_id}', NULL, '{existingStreamers}') "
-            f"ON DUPLICATE KEY UPDATE twitchChannel = '{existingStreamers}'"
-        )
+        await self.configCache.removeStreamer(ctx.guild_id, streamer['id'])
+        await self.configChanged(ctx.guild_id)
         embed.title = f"Removed {streamer['display_name']} from watch list"
         embed.colour = discord.Colour.blurple()
         await msg.edit(embed=embed)
@@ -440,22 +894,15 @@ class Twitch(commands.Cog):
             return await ctx.send("Sorry you need manage_messages to use this command", hidden=True)
         try:
             embeds = []
-            data = await self.bot.db.execute(
-                f"SELECT twitchChannel FROM twitching.twitch WHERE guildID = '{ctx.guild_id}'",
-                getOne=True
-            )
-            streamers = json.loads(data['twitchChannel'])
-            if streamers is not None:
-                streamerData = await self.bot.loop.run_in_executor(
-                    self.executor,
-                    functools.partial(
-                        self.twitch.get_users,
-                        user_ids=streamers))
+            config = self.configCache.get(ctx.guild_id)
+            streamers = list(config.twitchChannels) if config else None
+            if streamers:
+                streamerData = await self.twitch.get_users(user_ids=streamers, priority=Priority.INTERACTIVE)
                 streamerData = streamerData
                 streamerData = sorted(streamerData['data'], key=lambda k: k['login'])
                 for sData in streamerData:
                     embed = discord.Embed(title=sData['display_name'])
-                    embed.colour = await utilities.getDominantColour(self.bot, sData['profile_image_url'])
+                    embed.colour = await self.getColour(sData['profile_image_url'])
                     embed.description = sData['description']
                     embed.set_image(url=sData['profile_image_url'])
                     embed.url = f"https://twitch.tv/{sData['login']}"
@@ -482,6 +929,8 @@ class Twitch(commands.Cog):
                             ])
     async def mention(self, ctx: SlashContext, **kwargs):
         await ctx.defer()
+        if not self.check_perms(ctx):
+            return await ctx.send("Sorry you need manage_messages to use this command", hidden=True)
 
         role: discord.Role = kwargs['role']
         streamerName = kwargs['streamer'].lower() if "streamer" in kwargs else "all"
@@ -489,25 +938,21 @@ class Twitch(commands.Cog):
         if not role.mentionable:
             return await ctx.send(f"`{role.name}` is set to **not** be mentionable in your server settings")
 
-        # check if streamer is real
-        sData = await self.bot.loop.run_in_executor(
-            self.executor,
-            functools.partial(
-                self.twitch.get_users,
-                logins=streamerName))
-
-        sData = sData['data'][0] if sData['data'] else None
-        if sData is None:
-            return await ctx.send(f"Sorry I couldn't find a streamer called {streamerName}")
+        userID = "all"
+        if streamerName != "all":
+            # check if streamer is real
+            sData = await self.twitch.get_users(logins=streamerName, priority=Priority.INTERACTIVE)
 
-        data = await self.bot.db.escape(json.dumps({sData['user_id']: str(role.id)}))
+            sData = sData['data'][0] if sData['data'] else None
+            if sData is None:
+                return await ctx.send(f"Sorry I couldn't find a streamer called {streamerName}")
+            userID = sData['id']
 
-        await self.bot.db.execute(
-            f"INSERT INTO twitching.twitch (guildID, mentions) ('{ctx.guild_id}', '{data}') "
-            f"ON DUPLICATE KEY UPDATE mentions = '{data}'"
-        )
+        await self.configCache.setMention(ctx.guild_id, userID, role.id)
+        await self.configChanged(ctx.guild_id)
 
-        await ctx.send("")
+        await ctx.send(f"Mentioning `{role.name}` when "
+                       f"{'any streamer' if userID == 'all' else sData['display_name']} goes live")
 
 
 def setup(bot):
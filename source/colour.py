@@ -0,0 +1,90 @@
+"""Dominant colour extraction
+
+Every backend takes the raw bytes of an image and returns its dominant colour as an int (0xRRGGBB),
+or None if the image has no opaque pixels. They are CPU bound, so should be run in an executor
+"""
+import io
+import typing
+
+import numpy as np
+import scipy.cluster
+from PIL import Image
+
+THUMBNAIL_SIZE = (100, 100)
+"""Images are shrunk to this before analysis"""
+
+ALPHA_THRESHOLD = 128
+"""Pixels more transparent than this are ignored"""
+
+QUANTIZE_BITS = 4
+"""How many bits per channel the histogram backend keeps"""
+
+
+def decodePixels(imageData: bytes) -> np.ndarray:
+    """Decodes an image into an (N, 4) array of its opaque RGBA pixels"""
+    im = Image.open(io.BytesIO(imageData))
+
+    # thumbnail uses draft mode where the format supports it (ie jpeg),
+    # so the full size image is never decoded just to be shrunk
+    im.thumbnail(THUMBNAIL_SIZE, Image.NEAREST)
+    if im.mode != "RGBA":
+        im = im.convert("RGBA")
+
+    pixels = np.asarray(im).reshape(-1, 4)
+    return pixels[pixels[:, 3] >= ALPHA_THRESHOLD]
+
+
+def _toInt(rgb) -> int:
+    r, g, b = (int(c) for c in rgb[:3])
+    return (r << 16) + (g << 8) + b
+
+
+def histogramColour(imageData: bytes) -> typing.Union[int, None]:
+    """Finds the most common colour after quantizing each channel, fully vectorized
+
+    The result is the mean of the pixels in the most populated bucket, rather than the bucket's corner,
+    so it stays close to the actual colour"""
+    pixels = decodePixels(imageData)
+    if len(pixels) == 0:
+        return None
+
+    rgb = pixels[:, :3].astype(np.int64)
+    shift = 8 - QUANTIZE_BITS
+    quantized = rgb >> shift
+    buckets = (quantized[:, 0] << (2 * QUANTIZE_BITS)) | (quantized[:, 1] << QUANTIZE_BITS) | quantized[:, 2]
+
+    counts = np.bincount(buckets, minlength=1 << (3 * QUANTIZE_BITS))
+    peak = counts.argmax()
+    members = rgb[buckets == peak]
+    return _toInt(members.mean(axis=0).round())
+
+
+def kmeansColour(imageData: bytes) -> typing.Union[int, None]:
+    """Finds the largest of 5 k-means clusters, the original algorithm"""
+    pixels = decodePixels(imageData)
+    if len(pixels) == 0:
+        return None
+    ar = pixels[:, :3].astype(float)
+
+    codes, dist = scipy.cluster.vq.kmeans(ar, 5)
+    vecs, dist = scipy.cluster.vq.vq(ar, codes)  # assign codes
+    counts = np.bincount(vecs, minlength=len(codes))  # count occurrences
+    return _toInt(codes[counts.argmax()])
+
+
+BACKENDS: typing.Dict[str, typing.Callable[[bytes], typing.Union[int, None]]] = {
+    "histogram": histogramColour,
+    "kmeans": kmeansColour,
+}
+"""Every available colour extraction backend"""
+
+DEFAULT_BACKEND = "histogram"
+
+
+def dominantColour(imageData: bytes, backend: str = None) -> typing.Union[int, None]:
+    """Gets the dominant colour of an image using the chosen, or default, backend"""
+    try:
+        extractor = BACKENDS[backend or DEFAULT_BACKEND]
+    except KeyError:
+        raise ValueError(f"Unknown colour backend {backend}, expected one of {', '.join(BACKENDS)}")
+    return extractor(imageData)
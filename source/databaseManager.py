@@ -2,6 +2,7 @@ import asyncio
 import json
 import logging
 import os
+import traceback
 import typing
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
@@ -49,6 +50,118 @@ sshUser = data['sshUser']
 DBUser = data['dbUser']
 DBPass = data['dbPass']
 
+POOL_RECYCLE = 3600
+"""Seconds before an idle connection is replaced, well below mysql's wait_timeout"""
+HEALTH_CHECK_INTERVAL = 60
+"""Seconds between background checks of the connection pool"""
+MAX_RETRIES = 3
+"""How many times a query is retried after losing its connection"""
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 5
+
+LEASE_WAIT = 5
+"""Seconds each attempt to take a lease waits for its holder to release it"""
+LEASE_CHECK_INTERVAL = 5
+"""Seconds between checks that a held lease is still ours"""
+
+# mysql client errors that mean the connection was lost, rather than the query being bad
+DISCONNECT_ERRORS = {2003, 2006, 2013, 2055}
+
+
+def isDisconnect(e: Exception) -> bool:
+    """Checks if an exception was caused by losing the database connection"""
+    if isinstance(e, (aiomysql.OperationalError, aiomysql.InterfaceError)):
+        if e.args and e.args[0] in DISCONNECT_ERRORS:
+            return True
+    return isinstance(e, ConnectionError) or "cannot connect" in str(e).lower()
+
+
+class Lease:
+    """A named mysql lock (GET_LOCK), used to elect one process out of several to do something
+
+    The lock belongs to the connection that took it, so it is held on a dedicated connection. If the holder
+    dies or loses that connection, mysql releases the lock at once and a waiting process takes over"""
+
+    def __init__(self, db: "DBConnector", name: str):
+        self.db = db
+        self.name = name
+        self.held = False
+        self.connection: typing.Union[aiomysql.Connection, None] = None
+
+    async def _query(self, query: str, args: tuple):
+        if self.connection is None:
+            self.connection = await self.db.dbPool.acquire()
+        async with self.connection.cursor() as cursor:
+            await cursor.execute(query, args)
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def _drop(self):
+        """Discards the lease's connection, which releases the lock if it was held"""
+        self.held = False
+        if self.connection is not None:
+            self.connection.close()
+            await self.db.dbPool.release(self.connection)
+            self.connection = None
+
+    async def acquire(self, timeout: float = 0) -> bool:
+        """Tries to take the lease, waiting up to timeout seconds for the current holder to release it"""
+        try:
+            self.held = await self._query("SELECT GET_LOCK(%s, %s)", (self.name, timeout)) == 1
+        except Exception as e:
+            log.warning(f"Failed to acquire lease {self.name}: {e}")
+            await self._drop()
+        return self.held
+
+    async def check(self) -> bool:
+        """Checks the lease is still held by us, ie the connection hasn't been lost"""
+        try:
+            self.held = await self._query("SELECT IS_USED_LOCK(%s) = CONNECTION_ID()", (self.name,)) == 1
+        except Exception as e:
+            log.warning(f"Lost lease {self.name}: {e}")
+            await self._drop()
+        return self.held
+
+    async def release(self):
+        await self._drop()
+
+    async def _callback(self, callback: typing.Callable[[], typing.Awaitable]) -> bool:
+        """Runs one of campaign's callbacks, logging anything it raises so the campaign carries on"""
+        try:
+            await callback()
+            return True
+        except Exception as ex:
+            log.error('Ignoring exception in lease {} callback: {}'.format(
+                self.name, "".join(traceback.format_exception(type(ex), ex, ex.__traceback__))))
+            return False
+
+    async def campaign(self, onAcquired: typing.Callable[[], typing.Awaitable],
+                       onLost: typing.Callable[[], typing.Awaitable]):
+        """Holds the lease whenever possible, calling onAcquired when it is taken and onLost if it is lost
+
+        If onAcquired fails, the lease is given up and onLost is called to undo whatever it started,
+        before campaigning again. Runs until cancelled, which releases the lease"""
+        try:
+            while True:
+                if not self.held:
+                    if self.db.dbPool is None or not await self.acquire(LEASE_WAIT):
+                        # GET_LOCK already waited, unless the database is unavailable
+                        await asyncio.sleep(0 if self.connection is not None else LEASE_WAIT)
+                        continue
+                    log.info(f"Acquired lease {self.name}")
+                    if not await self._callback(onAcquired):
+                        await self.release()
+                        await self._callback(onLost)
+                        # give another process the chance to take it
+                        await asyncio.sleep(LEASE_WAIT)
+                        continue
+                await asyncio.sleep(LEASE_CHECK_INTERVAL)
+                if not await self.check():
+                    log.warning(f"Lease {self.name} was lost")
+                    await self._callback(onLost)
+        finally:
+            await self.release()
+
 
 class DBConnector:
     def __init__(self, loop=asyncio.get_event_loop()):
@@ -58,17 +171,15 @@ class DBConnector:
         self.threadPool = ThreadPoolExecutor(max_workers=4)
         self.operations = 0
         self.time = Time
+        self.healthTask: typing.Union[asyncio.Task, None] = None
 
     def teardown(self):
+        if self.healthTask:
+            self.healthTask.cancel()
         if self.tunnel:
             self.tunnel.close()
         self.threadPool.shutdown(wait=True)
 
-    async def escape(self, inputString: str):
-        """Escape the input"""
-        async with self.dbPool.acquire() as conn:
-            return conn.escape_string(inputString)
-
     async def _connect(self):
         """Creates a connection to the database, either directly or through a tunnel"""
         log.spam("Attempting to connect to local database")
@@ -79,7 +190,8 @@ class DBConnector:
                 host="127.0.0.1",
                 port=3306,
                 auth_plugin="mysql_native_password",
-                maxsize=10
+                maxsize=10,
+                pool_recycle=POOL_RECYCLE
             )
         except:
             # Probably working on a dev machine, create a tunnel
@@ -106,6 +218,7 @@ class DBConnector:
                     port=self.tunnel.local_bind_port,
                     auth_plugin="mysql_native_password",
                     maxsize=10,
+                    pool_recycle=POOL_RECYCLE
                 )
             except Exception as e:
                 log.critical(f"Failed to connect to db, aborting startup: {e}")
@@ -120,50 +233,143 @@ class DBConnector:
         log.info(f"Database connection established. {len(databases)} schemas found")
         return True
 
-    async def execute(self, query: str, getOne: bool = False) -> typing.Union[dict, None]:
+    async def _withRetry(self, operation: typing.Callable[[], typing.Awaitable], query: str,
+                         maxRetries: int = MAX_RETRIES):
+        """
+        Runs a database operation, retrying with backoff if the connection was lost
+        :param operation: A coroutine function that performs the operation
+        :param query: The query being run, for logging
+        :param maxRetries: How many times to retry, 0 to never retry
+        :return: The operation's result
+        """
+        for attempt in range(maxRetries + 1):
+            try:
+                result = await operation()
+                self.operations += 1
+                return result
+            except Exception as e:
+                if not isDisconnect(e) or attempt == maxRetries:
+                    raise
+                delay = min(RETRY_BACKOFF * 2 ** attempt, RETRY_BACKOFF_MAX)
+                log.warning(f"Lost connection to database ({e}), retrying in {delay}s - {query}")
+                await asyncio.sleep(delay)
+                # any other idle connections are likely dead too
+                await self.dbPool.clear()
+
+    async def execute(self, query: str, args: typing.Union[tuple, dict, None] = None,
+                      getOne: bool = False, getRowCount: bool = False,
+                      raiseErrors: bool = False, retry: bool = True) -> typing.Union[dict, int, None]:
         """
         Execute a database query
-        :param query: The query you want to make
+        :param query: The query you want to make, with %s placeholders for any args
+        :param args: Values to bind to the query's placeholders
         :param getOne: If you only want one item, set this to True
-        :return: a dict representing the mysql result, or None
+        :param getRowCount: If you want the number of affected rows, ie from an INSERT IGNORE, set this to True
+        :param raiseErrors: Raise anything the query fails with, rather than logging it and returning None
+        :param retry: Retry if the connection is lost, disable for anything that isn't safe to run twice, ie DDL
+        :return: a dict representing the mysql result, the affected row count, or None if the query failed
         """
 
-        try:
-            # make sure we have a connection first
-            async with self.dbPool.acquire() as conn:
-                await conn.ping(reconnect=True)  # ping the database, to make sure we have a connection
-        except Exception as e:
-            log.error(f"{e}")
-            await asyncio.sleep(5)  # sleep for a few seconds
-            await self.connect()  # Attempt to reconnect
-
-        try:
-            log.debug(f"Executing Query - {query}")
-
+        async def operation():
             async with self.dbPool.acquire() as connection:
-                async with connection.cursor(aiomysql.SSDictCursor) as cursor:
-                    await cursor.execute(query)  # execute the query
-                    if not getOne:
+                async with connection.cursor(aiomysql.Cursor if getRowCount else aiomysql.SSDictCursor) as cursor:
+                    await cursor.execute(query, args)  # execute the query
+                    if getRowCount:
+                        result = cursor.rowcount
+                    elif not getOne:
                         result = await cursor.fetchall()
                     else:
                         result = await cursor.fetchone()
-                    if isinstance(result, tuple):
-                        if len(result) == 0:
-                            return None
                     await cursor.close()
                 await connection.commit()
-            self.operations += 1
+            if isinstance(result, tuple):
+                if len(result) == 0:
+                    return None
             return result
+
+        try:
+            log.debug(f"Executing Query - {query} {args if args else ''}")
+            return await self._withRetry(operation, query, MAX_RETRIES if retry else 0)
         except Exception as e:
+            if raiseErrors:
+                raise
             log.error(e)
-            if "cannot connect" in str(e):
-                await asyncio.sleep(5)
-                await self.execute(query=query, getOne=getOne)
         return None
 
+    async def executemany(self, query: str, args: typing.Iterable[typing.Union[tuple, dict]],
+                          raiseErrors: bool = False) -> int:
+        """
+        Execute a query once for every set of args, inserts are batched into a single statement
+        :param query: The query you want to make, with %s placeholders for the args
+        :param args: An iterable of values to bind to the query's placeholders
+        :param raiseErrors: Raise anything the query fails with, rather than logging it and returning 0
+        :return: The number of affected rows
+        """
+        args = list(args)
+        if not args:
+            return 0
+
+        async def operation():
+            async with self.dbPool.acquire() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.executemany(query, args)
+                    rowCount = cursor.rowcount
+                await connection.commit()
+            return rowCount
+
+        try:
+            log.debug(f"Executing Query x{len(args)} - {query}")
+            return await self._withRetry(operation, query)
+        except Exception as e:
+            if raiseErrors:
+                raise
+            log.error(e)
+        return 0
+
+    async def _healthCheck(self):
+        """Periodically checks idle connections are alive, so dead ones aren't handed to queries"""
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            if self.dbPool is None:
+                continue
+            try:
+                async with self.dbPool.acquire() as conn:
+                    await conn.ping(reconnect=True)
+            except Exception as e:
+                log.warning(f"Database health check failed: {e}")
+                await self.dbPool.clear()
+
+    async def fetch_iter(self, query: str, args: typing.Union[tuple, dict, None] = None,
+                         batchSize: int = 500) -> typing.AsyncIterator[dict]:
+        """
+        Execute a query and stream the resulting rows, rather than buffering the whole result
+        :param query: The query you want to make, with %s placeholders for any args
+        :param args: Values to bind to the query's placeholders
+        :param batchSize: How many rows to read from the server at a time
+        """
+        log.debug(f"Streaming Query - {query} {args if args else ''}")
+
+        async with self.dbPool.acquire() as connection:
+            async with connection.cursor(aiomysql.SSDictCursor) as cursor:
+                await cursor.execute(query, args)
+                while True:
+                    rows = await cursor.fetchmany(batchSize)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            await connection.commit()
+        self.operations += 1
+
+    def lease(self, name: str) -> Lease:
+        """Creates a lease, see `Lease`"""
+        return Lease(self, name)
+
     async def connect(self):
         """Public function to connect to the database"""
         await self._connect()
+        if self.healthTask is None or self.healthTask.done():
+            self.healthTask = self.loop.create_task(self._healthCheck())
 
 
 class Time:
@@ -1,12 +1,14 @@
 import typing
 
+import aiohttp
 import discord
 from discord.ext import commands
 
-from . import databaseManager
+from . import databaseManager, utilities
+from .cluster import Cluster
 
 
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot):
     """Expands on the default bot class, and helps with type-hinting """
 
     def __init__(self, cogList=list, *args, **kwargs):
@@ -16,6 +18,9 @@ class Bot(commands.Bot):
         self.db = databaseManager.DBConnector()
         """The bots database"""
 
+        self.cluster = Cluster(self.db)
+        """Coordinates with the bot's other processes, if there are any"""
+
         self.appInfo: discord.AppInfo = None
         """A cached application info"""
 
@@ -28,27 +33,46 @@ class Bot(commands.Bot):
         self.perms = 0
         """The perms the bot needs"""
 
+        self.session: typing.Union[aiohttp.ClientSession, None] = None
+        """The http session shared by everything that makes outbound requests"""
+
         super().__init__(*args, **kwargs)
 
+    def createSession(self) -> aiohttp.ClientSession:
+        """Creates the shared http session, if it doesn't exist yet"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=200,  # helix polling can have a lot of requests in flight
+                limit_per_host=100,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+        return self.session
+
+    async def close(self):
+        await self.cluster.stop()
+        await super().close()
+        if self.session and not self.session.closed:
+            await self.session.close()
+        utilities.shutdownImagePool()
+        # anything waiting on the debounce would otherwise be lost
+        await utilities.colourCache.persister.flush()
+
     async def getMessage(self, messageID: int, channel: discord.TextChannel) -> typing.Union[discord.Message, None]:
         """Gets a message using the id given
-        we dont use the built in get_message due to poor rate limit
+
+        Only needed for notifications posted before their archive state was stored,
+        everything else is edited through getPartialMessage. Anything other than the message
+        being gone is raised, so the caller can decide whether to retry
         """
-        for message in self.cached_messages:
-            if message.id == messageID:
-                return message
-        # bot has not cached this message, so search the channel for it
         try:
-            o = discord.Object(id=messageID + 1)
-            msg = await channel.history(limit=1, before=o).next()
-
-            if messageID == msg.id:
-                return msg
-
-            return None
-        except discord.NoMoreItems:
+            return await channel.fetch_message(messageID)
+        except discord.NotFound:
             # the message could not be found
             return None
-        except Exception as e:
-            print(e)
-        return None
+
+    @staticmethod
+    def getPartialMessage(messageID: int, channel: discord.TextChannel) -> discord.PartialMessage:
+        """Gets a message that can be edited or deleted by id, without fetching it"""
+        return channel.get_partial_message(messageID)
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import traceback
+import typing
+from collections import deque
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+from . import utilities
+
+log: logging.Logger = utilities.getLog("eventsub", logging.INFO)
+
+STREAM_ONLINE = "stream.online"
+STREAM_OFFLINE = "stream.offline"
+
+MAX_MESSAGE_AGE = 10 * 60
+"""Messages older than this many seconds are rejected, as twitch recommends, to prevent replays"""
+
+SEEN_MESSAGES = 1000
+"""How many message IDs are remembered, as twitch may deliver the same message more than once"""
+
+Handler = typing.Callable[[dict], typing.Awaitable]
+
+
+def sign(secret: str, messageID: str, timestamp: str, body: bytes) -> str:
+    """Computes the value of the Twitch-Eventsub-Message-Signature header for a message"""
+    digest = hmac.new(secret.encode("utf-8"), messageID.encode("utf-8") + timestamp.encode("utf-8") + body,
+                      hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def parseTimestamp(timestamp: str) -> datetime:
+    """Parses twitch's RFC3339 timestamps, which can have more precision than datetime supports"""
+    timestamp = timestamp.rstrip("Z")
+    if "." in timestamp:
+        timestamp, fraction = timestamp.split(".", 1)
+        timestamp = f"{timestamp}.{fraction[:6]}"
+        parsed = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f")
+    else:
+        parsed = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S")
+    return parsed.replace(tzinfo=timezone.utc)
+
+
+class EventSubServer:
+    """Receives eventsub webhook deliveries from twitch
+
+    Every request's signature is verified against our secret before it is trusted. Notifications are
+    acknowledged immediately, and their handlers run in the background, as twitch expects a quick response"""
+
+    def __init__(self, secret: str, host: str = "0.0.0.0", port: int = 8080, path: str = "/eventsub"):
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.path = path
+
+        self.handlers: typing.Dict[str, typing.List[Handler]] = {}
+        """Subscription type -> handlers, called with the notification's event"""
+
+        self.revokedHandlers: typing.List[Handler] = []
+        """Called with the subscription, when twitch revokes one"""
+
+        self.seenIDs: typing.Set[str] = set()
+        self._seenOrder: typing.Deque[str] = deque()
+
+        self.stats = {"received": 0, "rejected": 0, "duplicates": 0, "revoked": 0}
+
+        self._runner: typing.Union[web.AppRunner, None] = None
+        self._tasks: typing.Set[asyncio.Task] = set()
+
+    def on(self, subType: str, handler: Handler):
+        """Calls handler with the event whenever a notification of subType is received"""
+        self.handlers.setdefault(subType, []).append(handler)
+
+    def onRevoked(self, handler: Handler):
+        """Calls handler with the subscription whenever twitch revokes one"""
+        self.revokedHandlers.append(handler)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handleRequest)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info(f"Listening for eventsub on {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        for task in list(self._tasks):
+            task.cancel()
+
+    def verify(self, headers, body: bytes) -> bool:
+        """Checks a request was signed with our secret, and isn't a replay of an old message"""
+        try:
+            messageID = headers['Twitch-Eventsub-Message-Id']
+            timestamp = headers['Twitch-Eventsub-Message-Timestamp']
+            signature = headers['Twitch-Eventsub-Message-Signature']
+            sentAt = parseTimestamp(timestamp)
+        except (KeyError, ValueError):
+            return False
+        if not hmac.compare_digest(sign(self.secret, messageID, timestamp, body), signature):
+            return False
+        return abs((datetime.now(timezone.utc) - sentAt).total_seconds()) <= MAX_MESSAGE_AGE
+
+    def _isDuplicate(self, messageID: str) -> bool:
+        if messageID in self.seenIDs:
+            return True
+        self.seenIDs.add(messageID)
+        self._seenOrder.append(messageID)
+        if len(self._seenOrder) > SEEN_MESSAGES:
+            self.seenIDs.discard(self._seenOrder.popleft())
+        return False
+
+    async def handleRequest(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        if not self.verify(request.headers, body):
+            self.stats['rejected'] += 1
+            log.warning(f"Rejected eventsub request from {request.remote}, bad signature or timestamp")
+            return web.Response(status=403)
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        messageType = request.headers.get('Twitch-Eventsub-Message-Type')
+
+        if messageType == "webhook_callback_verification":
+            log.debug(f"Verified subscription {payload['subscription']['type']} "
+                      f"for {payload['subscription']['condition']}")
+            return web.Response(text=payload['challenge'], content_type="text/plain")
+
+        if self._isDuplicate(request.headers['Twitch-Eventsub-Message-Id']):
+            self.stats['duplicates'] += 1
+            return web.Response(status=204)
+
+        if messageType == "notification":
+            self.stats['received'] += 1
+            handlers = self.handlers.get(payload['subscription']['type'], [])
+            self._dispatch(handlers, payload['event'])
+        elif messageType == "revocation":
+            self.stats['revoked'] += 1
+            log.warning(f"Subscription {payload['subscription']['type']} for "
+                        f"{payload['subscription']['condition']} revoked: {payload['subscription']['status']}")
+            self._dispatch(self.revokedHandlers, payload['subscription'])
+        return web.Response(status=204)
+
+    def _dispatch(self, handlers: typing.List[Handler], data: dict):
+        for handler in handlers:
+            task = asyncio.ensure_future(self._run(handler, data))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _run(handler: Handler, data: dict):
+        try:
+            await handler(data)
+        except Exception as ex:
+            log.error('Ignoring exception in eventsub handler: {}'.format(
+                "".join(traceback.format_exception(type(ex), ex, ex.__traceback__))))
@@ -0,0 +1,208 @@
+import logging
+import typing
+
+from . import utilities
+from .databaseManager import DBConnector
+
+log: logging.Logger = utilities.getLog("guildCache", logging.INFO)
+
+
+class GuildConfig:
+    """A guild's notification settings"""
+
+    __slots__ = ("guildID", "postChannel", "twitchChannels", "postedStreamIDs", "mentions")
+
+    def __init__(self, guildID: int, postChannel: typing.Union[int, None] = None,
+                 twitchChannels: set = None, postedStreamIDs: set = None, mentions: dict = None):
+        self.guildID = guildID
+        self.postChannel = postChannel
+        self.twitchChannels: set = twitchChannels if twitchChannels is not None else set()
+        self.postedStreamIDs: set = postedStreamIDs if postedStreamIDs is not None else set()
+        self.mentions: dict = mentions if mentions is not None else {}
+
+    @property
+    def active(self) -> bool:
+        """Does this guild want notifications"""
+        return self.postChannel is not None and len(self.twitchChannels) != 0
+
+
+class GuildConfigCache:
+    """A write-through cache of twitching.twitch and its join tables
+
+    Loaded in a few bulk queries at startup, after which reads never touch the database.
+    All writes to these tables should go through here so the cache stays in sync"""
+
+    def __init__(self, db: DBConnector):
+        self.db = db
+        self.configs: typing.Dict[int, GuildConfig] = {}
+
+        self.subscribers: typing.Dict[str, typing.Set[int]] = {}
+        """Which guilds track each streamer"""
+
+        self.postedRemoved: typing.Set[typing.Tuple[int, str]] = set()
+        """(guildID, streamID) pairs that ended since the last flush"""
+
+    def __iter__(self) -> typing.Iterator[GuildConfig]:
+        return iter(list(self.configs.values()))
+
+    def __len__(self):
+        return len(self.configs)
+
+    async def load(self):
+        """Loads every guild's config from the database"""
+        self.configs = {}
+        self.subscribers = {}
+        async for row in self.db.fetch_iter("SELECT guildID, postChannel FROM twitching.twitch"):
+            config = self._getOrCreate(row['guildID'])
+            config.postChannel = int(row['postChannel']) if row['postChannel'] else None
+
+        async for row in self.db.fetch_iter("SELECT guildID, twitchChannel FROM twitching.subscriptions"):
+            config = self._getOrCreate(row['guildID'])
+            config.twitchChannels.add(row['twitchChannel'])
+            self.subscribers.setdefault(row['twitchChannel'], set()).add(config.guildID)
+
+        async for row in self.db.fetch_iter("SELECT guildID, twitchChannel, roleID FROM twitching.mentions"):
+            self._getOrCreate(row['guildID']).mentions[row['twitchChannel']] = row['roleID']
+
+        async for row in self.db.fetch_iter("SELECT guildID, streamID FROM twitching.postedStreams"):
+            self._getOrCreate(row['guildID']).postedStreamIDs.add(row['streamID'])
+
+        log.info(f"Cached config for {len(self.configs)} guilds, tracking {len(self.subscribers)} streamers")
+
+    async def reloadGuild(self, guildID: int):
+        """Reloads a single guild's settings, ie after another process changed them
+
+        Posted streams are kept as they are, as only the process that posts for a guild changes them"""
+        guildID = int(guildID)
+        old = self.configs.pop(guildID, None)
+        config = self._getOrCreate(guildID)
+        if old is not None:
+            config.postedStreamIDs = old.postedStreamIDs
+            for userID in old.twitchChannels:
+                guilds = self.subscribers.get(userID)
+                if guilds is not None:
+                    guilds.discard(guildID)
+                    if not guilds:
+                        del self.subscribers[userID]
+
+        row = await self.db.execute("SELECT postChannel FROM twitching.twitch WHERE guildID = %s",
+                                    (str(guildID),), getOne=True)
+        if row and row['postChannel']:
+            config.postChannel = int(row['postChannel'])
+        async for row in self.db.fetch_iter("SELECT twitchChannel FROM twitching.subscriptions WHERE guildID = %s",
+                                            (str(guildID),)):
+            config.twitchChannels.add(row['twitchChannel'])
+            self.subscribers.setdefault(row['twitchChannel'], set()).add(guildID)
+        async for row in self.db.fetch_iter("SELECT twitchChannel, roleID FROM twitching.mentions WHERE guildID = %s",
+                                            (str(guildID),)):
+            config.mentions[row['twitchChannel']] = row['roleID']
+
+    def get(self, guildID: int) -> typing.Union[GuildConfig, None]:
+        """Gets a guild's config, if it has one"""
+        return self.configs.get(int(guildID))
+
+    def guildsTracking(self, userID: str) -> typing.Set[int]:
+        """Gets the IDs of every guild tracking a streamer"""
+        return set(self.subscribers.get(userID, ()))
+
+    def _getOrCreate(self, guildID: int) -> GuildConfig:
+        guildID = int(guildID)
+        if guildID not in self.configs:
+            self.configs[guildID] = GuildConfig(guildID)
+        return self.configs[guildID]
+
+    async def setPostChannel(self, guildID: int, channelID: typing.Union[int, None]):
+        """Sets, or clears, the channel a guild's notifications are posted in"""
+        config = self._getOrCreate(guildID)
+        await self.db.execute(
+            "INSERT INTO twitching.twitch (guildID, postChannel) "
+            "VALUES (%s, %s) "
+            "ON DUPLICATE KEY UPDATE postChannel = VALUES(postChannel)",
+            (str(config.guildID), str(channelID) if channelID is not None else None)
+        )
+        config.postChannel = channelID
+
+    async def addStreamer(self, guildID: int, userID: str):
+        """Adds a streamer to a guild's tracked list"""
+        config = self._getOrCreate(guildID)
+        await self.db.execute(
+            "INSERT IGNORE INTO twitching.subscriptions (guildID, twitchChannel) VALUES (%s, %s)",
+            (str(config.guildID), userID)
+        )
+        config.twitchChannels.add(userID)
+        self.subscribers.setdefault(userID, set()).add(config.guildID)
+
+    async def removeStreamer(self, guildID: int, userID: str):
+        """Removes a streamer from a guild's tracked list"""
+        config = self._getOrCreate(guildID)
+        await self.db.execute(
+            "DELETE FROM twitching.subscriptions WHERE guildID = %s AND twitchChannel = %s",
+            (str(config.guildID), userID)
+        )
+        config.twitchChannels.discard(userID)
+        if userID in self.subscribers:
+            self.subscribers[userID].discard(config.guildID)
+            if not self.subscribers[userID]:
+                del self.subscribers[userID]
+
+    async def setMention(self, guildID: int, userID: str, roleID: int):
+        """Sets the role to mention when a streamer goes live, userID can be `all`"""
+        config = self._getOrCreate(guildID)
+        await self.db.execute(
+            "INSERT INTO twitching.mentions (guildID, twitchChannel, roleID) VALUES (%s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE roleID = VALUES(roleID)",
+            (str(config.guildID), userID, str(roleID))
+        )
+        config.mentions[userID] = str(roleID)
+
+    async def claimStream(self, guildID: int, streamID: str) -> bool:
+        """Atomically claims the right to notify a guild of a stream
+
+        The claim is the guild's postedStreams row, so of every process and restart that tries,
+        only the one whose insert lands posts the notification
+        :return: True if the caller should post, False if it has been claimed already, or the claim failed"""
+        config = self._getOrCreate(guildID)
+        if streamID in config.postedStreamIDs:
+            return False
+        inserted = await self.db.execute(
+            "INSERT IGNORE INTO twitching.postedStreams (guildID, streamID) VALUES (%s, %s)",
+            (str(config.guildID), streamID), getRowCount=True
+        )
+        if inserted is None:
+            log.error(f"Failed to claim stream {streamID} for {config.guildID}, not posting")
+            return False
+        # whether we won or lost, the stream has now been posted in this guild
+        config.postedStreamIDs.add(streamID)
+        self.postedRemoved.discard((config.guildID, streamID))
+        return inserted == 1
+
+    async def releaseStream(self, guildID: int, streamID: str):
+        """Gives up a claim, ie when the notification couldn't be posted, so it can be retried"""
+        config = self._getOrCreate(guildID)
+        await self.db.execute(
+            "DELETE FROM twitching.postedStreams WHERE guildID = %s AND streamID = %s",
+            (str(config.guildID), streamID)
+        )
+        config.postedStreamIDs.discard(streamID)
+
+    def endStreams(self, guildID: int, streamIDs: typing.Iterable[str]):
+        """Forgets streams a guild was notified of, once they have ended
+
+        Posts are written as they are claimed, this is only written to the database on the next `flush`"""
+        config = self._getOrCreate(guildID)
+        for streamID in config.postedStreamIDs.intersection(streamIDs):
+            self.postedRemoved.add((config.guildID, streamID))
+            config.postedStreamIDs.discard(streamID)
+
+    async def flush(self):
+        """Removes every guild's ended streams from the database, in a single query"""
+        removed, self.postedRemoved = self.postedRemoved, set()
+
+        if removed:
+            # executemany only batches inserts, a delete would be sent once per row
+            await self.db.execute(
+                "DELETE FROM twitching.postedStreams WHERE (guildID, streamID) IN "
+                f"({', '.join(['(%s, %s)'] * len(removed))})",
+                tuple(value for guildID, streamID in removed for value in (str(guildID), streamID))
+            )
+            log.debug(f"Flushed {len(removed)} ended posted streams")
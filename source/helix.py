@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import typing
+from time import time
+
+import aiohttp
+
+from . import utilities
+from .ratelimit import RateLimiter, Priority
+
+log: logging.Logger = utilities.getLog("helix", logging.INFO)
+
+AUTH_URL = "https://id.twitch.tv/oauth2/token"
+BASE_URL = "https://api.twitch.tv/helix/"
+MAX_RETRIES = 3
+"""How many times a rate limited request is retried before giving up"""
+
+BATCH_SIZE = 100
+"""The maximum number of users helix will accept in a single request"""
+
+
+class HelixAuthorizationException(Exception):
+    """Raised when twitch refuses to issue an app access token"""
+    pass
+
+
+class HelixClient:
+    """A native asyncio client for the parts of the twitch helix api the bot uses
+
+    All requests share one keep-alive connection pool, so polling can have many requests in flight
+    on the event loop without needing threads"""
+
+    def __init__(self, app_id: str, app_secret: str, session: aiohttp.ClientSession = None):
+        self.appID = app_id
+        self.appSecret = app_secret
+
+        self.session: typing.Union[aiohttp.ClientSession, None] = session
+        """The session all requests are made through, normally the bot's shared session"""
+
+        self.token: typing.Union[str, None] = None
+        """The current app access token"""
+
+        self.tokenExpires: float = 0
+        """When the current token expires"""
+
+        self.limiter = RateLimiter()
+        """Schedules requests within twitch's rate limit"""
+
+        self._tokenLock = asyncio.Lock()
+        self._ownsSession = False
+
+    async def _getSession(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            # no shared session was given, ie when used outside the bot
+            connector = aiohttp.TCPConnector(limit=100, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector)
+            self._ownsSession = True
+        return self.session
+
+    async def close(self):
+        """Closes the underlying session, if this client created it"""
+        if self._ownsSession and self.session and not self.session.closed:
+            await self.session.close()
+
+    async def authenticate(self):
+        """Obtains a new app access token using the client credentials flow"""
+        session = await self._getSession()
+        params = {
+            "client_id": self.appID,
+            "client_secret": self.appSecret,
+            "grant_type": "client_credentials"
+        }
+        async with session.post(AUTH_URL, params=params) as r:
+            data = await r.json()
+            if r.status != 200 or "access_token" not in data:
+                raise HelixAuthorizationException(data.get("message", f"Unexpected status {r.status}"))
+        self.token = data['access_token']
+        # refresh a minute early, so in-flight requests don't race the expiry
+        self.tokenExpires = time() + data.get('expires_in', 3600) - 60
+        log.debug("Obtained app access token")
+
+    async def _ensureToken(self, force: bool = False):
+        """Makes sure we hold a valid token, refreshing it if needed"""
+        async with self._tokenLock:
+            if force or self.token is None or time() >= self.tokenExpires:
+                await self.authenticate()
+
+    async def request(self, endpoint: str, params: typing.List[tuple] = None,
+                      priority: Priority = Priority.BACKGROUND, method: str = "GET",
+                      json: dict = None) -> typing.Union[dict, None]:
+        """Makes a request to a helix endpoint
+
+        :param endpoint: The endpoint, relative to the helix root
+        :param params: The query parameters, as a list of tuples to allow repeated keys
+        :param priority: The priority this request is queued with
+        :param method: The http method to use
+        :param json: The body to send, if any
+        :return: The decoded json response, or None if there was no content
+        """
+        await self._ensureToken()
+        session = await self._getSession()
+
+        refreshed = False
+        retries = 0
+        while True:
+            await self.limiter.acquire(priority)
+            headers = {
+                "Client-ID": self.appID,
+                "Authorization": f"Bearer {self.token}"
+            }
+            async with session.request(method, BASE_URL + endpoint, params=params, headers=headers,
+                                       json=json) as r:
+                self.limiter.update(r.headers)
+                if r.status == 401 and not refreshed:
+                    # token was revoked or expired early, get a new one and try again
+                    log.warning("App access token rejected, refreshing")
+                    refreshed = True
+                    await self._ensureToken(force=True)
+                    continue
+                if r.status == 429 and retries < MAX_RETRIES:
+                    log.warning(f"Rate limited on {endpoint}, retrying")
+                    retries += 1
+                    self.limiter.exhausted(r.headers)
+                    continue
+                r.raise_for_status()
+                if r.status == 204:
+                    return None
+                return await r.json()
+
+    async def get_users(self, user_ids: typing.List[str] = None,
+                        logins: typing.Union[typing.List[str], str] = None,
+                        priority: Priority = Priority.BACKGROUND) -> dict:
+        """Gets information about one or more users, by id or login"""
+        params = []
+        if user_ids:
+            params += [("id", u) for u in ([user_ids] if isinstance(user_ids, str) else user_ids)]
+        if logins:
+            params += [("login", u) for u in ([logins] if isinstance(logins, str) else logins)]
+        return await self.request("users", params, priority)
+
+    async def get_streams(self, user_id: typing.Union[typing.List[str], str] = None,
+                          user_login: typing.Union[typing.List[str], str] = None, first: int = 20,
+                          priority: Priority = Priority.BACKGROUND) -> dict:
+        """Gets information about active streams for the given users"""
+        params = [("first", str(first))]
+        if user_id:
+            params += [("user_id", u) for u in ([user_id] if isinstance(user_id, str) else user_id)]
+        if user_login:
+            params += [("user_login", u) for u in ([user_login] if isinstance(user_login, str) else user_login)]
+        return await self.request("streams", params, priority)
+
+    async def get_eventsub_subscriptions(self, status: str = None,
+                                         priority: Priority = Priority.BACKGROUND) -> typing.List[dict]:
+        """Gets every eventsub subscription this app has, following pagination"""
+        subscriptions = []
+        cursor = None
+        while True:
+            params = []
+            if status:
+                params.append(("status", status))
+            if cursor:
+                params.append(("after", cursor))
+            data = await self.request("eventsub/subscriptions", params, priority)
+            subscriptions += data['data']
+            cursor = data.get('pagination', {}).get('cursor')
+            if not cursor:
+                return subscriptions
+
+    async def create_eventsub_subscription(self, subType: str, condition: dict, callback: str, secret: str,
+                                           priority: Priority = Priority.BACKGROUND) -> dict:
+        """Subscribes to an eventsub topic, delivered to a webhook"""
+        body = {
+            "type": subType,
+            "version": "1",
+            "condition": condition,
+            "transport": {
+                "method": "webhook",
+                "callback": callback,
+                "secret": secret
+            }
+        }
+        return await self.request("eventsub/subscriptions", priority=priority, method="POST", json=body)
+
+    async def delete_eventsub_subscription(self, subscriptionID: str,
+                                           priority: Priority = Priority.BACKGROUND):
+        """Removes an eventsub subscription"""
+        await self.request("eventsub/subscriptions", [("id", subscriptionID)], priority, method="DELETE")
@@ -0,0 +1,186 @@
+import json
+import logging
+import typing
+
+from . import utilities
+from .databaseManager import DBConnector
+
+log: logging.Logger = utilities.getLog("migrations", logging.INFO)
+
+
+def _loadJSON(value, default):
+    try:
+        return json.loads(value) if value else default
+    except ValueError:
+        return default
+
+
+async def createJoinTables(db: DBConnector):
+    """Moves the json columns of twitching.twitch and twitching.streams into indexed join tables
+
+    The old columns are left in place, but are no longer read or written"""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS twitching.subscriptions ("
+        "guildID VARCHAR(20) NOT NULL, "
+        "twitchChannel VARCHAR(20) NOT NULL, "
+        "PRIMARY KEY (guildID, twitchChannel), "
+        "INDEX idx_subscriptions_twitchChannel (twitchChannel))",
+        raiseErrors=True
+    )
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS twitching.mentions ("
+        "guildID VARCHAR(20) NOT NULL, "
+        "twitchChannel VARCHAR(20) NOT NULL, "
+        "roleID VARCHAR(20) NOT NULL, "
+        "PRIMARY KEY (guildID, twitchChannel))",
+        raiseErrors=True
+    )
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS twitching.postedStreams ("
+        "guildID VARCHAR(20) NOT NULL, "
+        "streamID VARCHAR(20) NOT NULL, "
+        "PRIMARY KEY (guildID, streamID), "
+        "INDEX idx_postedStreams_streamID (streamID))",
+        raiseErrors=True
+    )
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS twitching.postedMessages ("
+        "messageID VARCHAR(20) NOT NULL, "
+        "channelID VARCHAR(20) NOT NULL, "
+        "streamID VARCHAR(20) NOT NULL, "
+        "twitchChannel VARCHAR(25) NOT NULL, "
+        "PRIMARY KEY (messageID), "
+        "INDEX idx_postedMessages_streamID (streamID), "
+        "INDEX idx_postedMessages_twitchChannel (twitchChannel))",
+        raiseErrors=True
+    )
+
+    subscriptions, mentions, postedStreams = [], [], []
+    async for row in db.fetch_iter("SELECT * FROM twitching.twitch"):
+        guildID = str(row['guildID'])
+        subscriptions += [(guildID, str(c)) for c in _loadJSON(row.get('twitchChannel'), [])]
+        mentions += [(guildID, str(c), str(r)) for c, r in _loadJSON(row.get('mentions'), {}).items()]
+        postedStreams += [(guildID, str(s)) for s in _loadJSON(row.get('postedStreamIDs'), [])]
+
+    postedMessages = []
+    async for row in db.fetch_iter("SELECT * FROM twitching.streams"):
+        postedMessages += [(str(m), str(c), str(row['streamID']), row['twitchChannel'])
+                           for c, m in _loadJSON(row.get('postedMessages'), [])]
+
+    await db.executemany(
+        "INSERT IGNORE INTO twitching.subscriptions (guildID, twitchChannel) VALUES (%s, %s)", subscriptions,
+        raiseErrors=True
+    )
+    await db.executemany(
+        "INSERT IGNORE INTO twitching.mentions (guildID, twitchChannel, roleID) VALUES (%s, %s, %s)", mentions,
+        raiseErrors=True
+    )
+    await db.executemany(
+        "INSERT IGNORE INTO twitching.postedStreams (guildID, streamID) VALUES (%s, %s)", postedStreams,
+        raiseErrors=True
+    )
+    await db.executemany(
+        "INSERT IGNORE INTO twitching.postedMessages (messageID, channelID, streamID, twitchChannel) "
+        "VALUES (%s, %s, %s, %s)", postedMessages,
+        raiseErrors=True
+    )
+    log.info(f"Migrated {len(subscriptions)} subscriptions, {len(mentions)} mentions, "
+             f"{len(postedStreams)} posted streams and {len(postedMessages)} posted messages")
+
+
+async def _columnExists(db: DBConnector, table: str, column: str) -> bool:
+    row = await db.execute(
+        "SELECT COUNT(*) AS found FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = 'twitching' AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+        (table, column), getOne=True, raiseErrors=True
+    )
+    return bool(row and row['found'])
+
+
+async def _indexExists(db: DBConnector, table: str, index: str) -> bool:
+    row = await db.execute(
+        "SELECT COUNT(*) AS found FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = 'twitching' AND TABLE_NAME = %s AND INDEX_NAME = %s",
+        (table, index), getOne=True, raiseErrors=True
+    )
+    return bool(row and row['found'])
+
+
+async def _alter(db: DBConnector, table: str, definitions: typing.List[str]):
+    """Alters a table, without retrying, as an ALTER that ran before the connection was lost would fail if resent
+
+    Migrations that alter must check what already exists, so they can run again after being interrupted"""
+    if definitions:
+        await db.execute(f"ALTER TABLE twitching.{table} {', '.join(definitions)}", raiseErrors=True, retry=False)
+
+
+async def storeArchiveState(db: DBConnector):
+    """Stores what is needed to render an archived notification alongside each posted message"""
+    columns = {
+        "displayName": "ADD COLUMN displayName VARCHAR(64) NULL",
+        "avatarURL": "ADD COLUMN avatarURL VARCHAR(512) NULL",
+        "title": "ADD COLUMN title TEXT NULL"
+    }
+    await _alter(db, "postedMessages", [definition for column, definition in columns.items()
+                                        if not await _columnExists(db, "postedMessages", column)])
+
+
+async def persistArchiveQueue(db: DBConnector):
+    """Flags posted messages that are queued to be archived, so the queue survives a restart"""
+    definitions = []
+    if not await _columnExists(db, "postedMessages", "archiving"):
+        definitions.append("ADD COLUMN archiving TINYINT(1) NOT NULL DEFAULT 0")
+    if not await _indexExists(db, "postedMessages", "idx_postedMessages_archiving"):
+        definitions.append("ADD INDEX idx_postedMessages_archiving (archiving)")
+    await _alter(db, "postedMessages", definitions)
+
+
+async def createClusterTables(db: DBConnector):
+    """Tables the processes of a cluster coordinate through"""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS twitching.workers ("
+        "workerID VARCHAR(64) NOT NULL PRIMARY KEY, "
+        "heartbeat DATETIME NOT NULL)",
+        raiseErrors=True
+    )
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS twitching.streamEvents ("
+        "id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, "
+        "workerID VARCHAR(64) NOT NULL, "
+        "event VARCHAR(32) NOT NULL, "
+        "userID VARCHAR(20) NULL, "
+        "payload TEXT NOT NULL, "
+        "createdAt DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3), "
+        "INDEX idx_streamEvents_createdAt (createdAt))",
+        raiseErrors=True
+    )
+
+
+MIGRATIONS: typing.List[typing.Tuple[str, typing.Callable[[DBConnector], typing.Awaitable]]] = [
+    ("0001_join_tables", createJoinTables),
+    ("0002_archive_state", storeArchiveState),
+    ("0003_archive_queue", persistArchiveQueue),
+    ("0004_cluster", createClusterTables),
+]
+"""Every migration, in the order they must be applied. Never reorder or rename these"""
+
+
+async def migrate(db: DBConnector):
+    """Applies any migrations that haven't been applied yet
+
+    A migration is only recorded once every statement in it has succeeded, anything that fails raises,
+    stopping here so it and everything after it is retried on the next startup"""
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS twitching.migrations ("
+        "name VARCHAR(64) NOT NULL PRIMARY KEY, "
+        "appliedAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)",
+        raiseErrors=True
+    )
+    applied = {row['name'] async for row in db.fetch_iter("SELECT name FROM twitching.migrations")}
+
+    for name, migration in MIGRATIONS:
+        if name in applied:
+            continue
+        log.info(f"Applying migration {name}")
+        await migration(db)
+        await db.execute("INSERT INTO twitching.migrations (name) VALUES (%s)", (name,), raiseErrors=True)
@@ -0,0 +1,220 @@
+import json
+import logging
+import math
+import typing
+from enum import Enum
+from time import time
+
+from . import utilities
+from .helix import BATCH_SIZE
+
+log: logging.Logger = utilities.getLog("pollScheduler", logging.INFO)
+
+HOUR = 60 * 60
+WEEK_HOURS = 7 * 24
+
+LIKELY_MIN_WEEKS = 2
+"""How many times a streamer must have been live in an hour of the week for it to count as usual"""
+
+DORMANT_AFTER = 14 * 24 * HOUR
+"""Streamers not seen live for this long are polled least often"""
+
+MAX_STRETCH = 10
+"""The most the budget may stretch an interval by"""
+
+REBALANCE_STEPS = 20
+"""Bisection steps when fitting the intervals to the budget"""
+
+TICK_SLACK = 5
+"""Seconds of leeway when deciding if a streamer is due, so a one minute interval fires every tick"""
+
+
+class Tier(Enum):
+    LIVE = "live"
+    """Currently live, polled every tick so they're archived promptly"""
+    LIKELY = "likely"
+    """Usually live around this time of the week"""
+    ACTIVE = "active"
+    """Streamed recently, or not known for long"""
+    DORMANT = "dormant"
+    """Not seen live for a long time"""
+
+
+BASE_INTERVALS: typing.Dict[Tier, float] = {
+    Tier.LIVE: 60,
+    Tier.LIKELY: 60,
+    Tier.ACTIVE: 3 * 60,
+    Tier.DORMANT: 10 * 60,
+}
+"""Seconds between polls of each tier, before the budget is applied
+
+These set how often each tier is polled relative to the others. Every tier but LIVE is then scaled evenly
+to use the whole budget, but never polled more often than LIVE"""
+
+
+def hourOfWeek(timestamp: float) -> int:
+    # the unix epoch was a thursday, which is fine as buckets only need to be consistent
+    return int(timestamp // HOUR) % WEEK_HOURS
+
+
+class PollScheduler:
+    """Decides which streamers are polled each tick
+
+    Each streamer is sorted into a tier from when they have been seen live, and polled at that tier's interval.
+    Every tier but LIVE is sped up or slowed down evenly so polling uses as much of the API budget as it can
+    without exceeding it, so a small bot polls everyone every tick. Live history is persisted, so tiers
+    survive a restart"""
+
+    def __init__(self, budget: int = 400, path: str = "data/pollHistory.json"):
+        self.budget = budget
+        """Helix requests per minute polling may use"""
+
+        self.history: typing.Dict[str, dict] = {}
+        """userID -> {"hours": {hour of week: times live}, "lastLive": timestamp, "firstSeen": timestamp,
+        "lastHour": the last absolute hour they were counted live in}"""
+
+        self.nextPoll: typing.Dict[str, float] = {}
+        self.tiers: typing.Dict[str, Tier] = {}
+        self.stretch: float = 1
+        """How much the budget is currently scaling every tier but LIVE, below 1 polls them more often"""
+
+        self.persister = utilities.JSONPersister(path, self.snapshot, "poll history")
+
+    def load(self):
+        """Loads persisted live history, if there is any"""
+        try:
+            with open(self.persister.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            log.warning(f"Discarding malformed poll history: {e}")
+            return
+        for userID, entry in data.items():
+            entry['hours'] = {int(h): c for h, c in entry.get('hours', {}).items()}
+            self.history[userID] = entry
+
+    def snapshot(self) -> dict:
+        """Copies the history, so it can be written from a thread"""
+        return {userID: dict(entry, hours=dict(entry['hours'])) for userID, entry in self.history.items()}
+
+    def forget(self, userID: str):
+        """Stops scheduling a streamer, their history is kept in case they're tracked again"""
+        self.nextPoll.pop(userID, None)
+        self.tiers.pop(userID, None)
+
+    def tierOf(self, userID: str, live: bool, now: float) -> Tier:
+        if live:
+            return Tier.LIVE
+        entry = self.history.get(userID)
+        if entry is None:
+            return Tier.ACTIVE
+
+        hours = entry['hours']
+        thisHour = hourOfWeek(now)
+        if max(hours.get(thisHour, 0), hours.get((thisHour + 1) % WEEK_HOURS, 0)) >= LIKELY_MIN_WEEKS:
+            return Tier.LIKELY
+
+        lastSeen = entry.get('lastLive') or entry['firstSeen']
+        if now - lastSeen > DORMANT_AFTER:
+            return Tier.DORMANT
+        return Tier.ACTIVE
+
+    @staticmethod
+    def _scaled(tier: Tier, stretch: float) -> float:
+        if tier == Tier.LIVE:
+            return BASE_INTERVALS[tier]
+        return max(BASE_INTERVALS[Tier.LIVE], BASE_INTERVALS[tier] * stretch)
+
+    def interval(self, tier: Tier) -> float:
+        """The effective number of seconds between polls of a tier"""
+        return self._scaled(tier, self.stretch)
+
+    def _rebalance(self):
+        """Works out the stretch that polls every tier but LIVE as often as the budget allows"""
+        counts = self.tierCounts()
+        # users polled per minute, and two requests per BATCH_SIZE of them
+        available = self.budget * BATCH_SIZE / 2 - counts[Tier.LIVE] * 60 / BASE_INTERVALS[Tier.LIVE]
+        flexible = [t for t in Tier if t != Tier.LIVE and counts[t]]
+
+        def usersPerMinute(stretch: float) -> float:
+            return sum(counts[t] * 60 / self._scaled(t, stretch) for t in flexible)
+
+        # below this every tier is already polled as often as LIVE
+        low = BASE_INTERVALS[Tier.LIVE] / max(BASE_INTERVALS.values())
+        if usersPerMinute(low) <= available:
+            self.stretch = low
+        elif usersPerMinute(MAX_STRETCH) >= available:
+            self.stretch = MAX_STRETCH
+        else:
+            high = MAX_STRETCH
+            for _ in range(REBALANCE_STEPS):
+                middle = (low + high) / 2
+                if usersPerMinute(middle) <= available:
+                    high = middle
+                else:
+                    low = middle
+            self.stretch = high
+
+    def due(self, userIDs: typing.Iterable[str], isLive: typing.Callable[[str], bool],
+            period: float = 60) -> typing.List[str]:
+        """Gets which of the tracked streamers should be polled now
+
+        At most a tick's worth of budget is returned, live streamers then the longest overdue first,
+        so a burst (ie on startup) is spread over the following ticks
+
+        :param period: Seconds between ticks
+        """
+        now = time()
+        userIDs = list(userIDs)
+        for userID in userIDs:
+            if userID not in self.history:
+                self.history[userID] = {"hours": {}, "lastLive": None, "firstSeen": now, "lastHour": None}
+                self.persister.schedule()
+            self.tiers[userID] = self.tierOf(userID, isLive(userID), now)
+        self._rebalance()
+
+        due = [userID for userID in userIDs if self.nextPoll.get(userID, 0) <= now + TICK_SLACK]
+        limit = int(self.budget * period / 60) // 2 * BATCH_SIZE
+        if len(due) > limit:
+            due.sort(key=lambda u: (self.tiers[u] != Tier.LIVE, self.nextPoll.get(u, 0)))
+            due = due[:limit]
+        return due
+
+    def polled(self, userIDs: typing.Iterable[str], liveIDs: typing.Set[str]):
+        """Records a poll's results, and schedules each streamer's next poll"""
+        now = time()
+        absoluteHour = int(now // HOUR)
+        for userID in userIDs:
+            live = userID in liveIDs
+            entry = self.history.setdefault(userID, {"hours": {}, "lastLive": None, "firstSeen": now,
+                                                     "lastHour": None})
+            if live:
+                entry['lastLive'] = now
+                if entry['lastHour'] != absoluteHour:
+                    # count each hour once, however often they're polled in it
+                    bucket = hourOfWeek(now)
+                    entry['hours'][bucket] = entry['hours'].get(bucket, 0) + 1
+                    entry['lastHour'] = absoluteHour
+                self.persister.schedule()
+            tier = self.tierOf(userID, live, now)
+            self.tiers[userID] = tier
+            self.nextPoll[userID] = now + self.interval(tier)
+
+    def tierCounts(self) -> typing.Dict[Tier, int]:
+        counts = {tier: 0 for tier in Tier}
+        for tier in self.tiers.values():
+            counts[tier] += 1
+        return counts
+
+    @property
+    def requestsPerMinute(self) -> float:
+        """The estimated helix requests per minute at the current intervals"""
+        counts = self.tierCounts()
+        usersPerMinute = sum(counts[t] * 60 / self.interval(t) for t in Tier)
+        return 2 * math.ceil(usersPerMinute / BATCH_SIZE)
+
+    def report(self) -> typing.Dict[str, str]:
+        """Summarises each tier's size and effective interval"""
+        counts = self.tierCounts()
+        return {tier.value: f"{counts[tier]} every {self.interval(tier) / 60:.1f}m" for tier in Tier}
@@ -0,0 +1,136 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import typing
+from enum import IntEnum
+from time import time
+
+from . import utilities
+
+log: logging.Logger = utilities.getLog("ratelimit", logging.INFO)
+
+
+class Priority(IntEnum):
+    """The order queued requests are let through in, lowest first"""
+    INTERACTIVE = 0
+    """Requests a user is actively waiting on, ie slash commands"""
+    BACKGROUND = 1
+    """Requests made by background tasks, ie polling"""
+
+
+class RateLimiter:
+    """A token bucket that follows twitch's Ratelimit-* headers
+
+    Interactive requests are let through as soon as there is budget,
+    background requests are spaced evenly across whatever is left of the window,
+    so a large poll cycle doesn't exhaust the bucket in one burst"""
+
+    def __init__(self, limit: int = 800, window: float = 60):
+        self.limit = limit
+        """The size of the bucket"""
+
+        self.window = window
+        """How long it takes the bucket to refill, used until twitch tells us otherwise"""
+
+        self.remaining = limit
+        """How many requests we can still make this window"""
+
+        self.reset = time() + window
+        """When the bucket refills"""
+
+        self.stats = {
+            "queued": 0,
+            "dispatched": 0,
+            "throttled": 0,
+            "retried": 0
+        }
+        """Counters of requests passing through the limiter"""
+
+        self._queue: typing.List[list] = []
+        self._sequence = itertools.count()
+        self._nextBackground = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: typing.Union[asyncio.Task, None] = None
+
+    @property
+    def pending(self) -> int:
+        """How many requests are currently waiting"""
+        return len(self._queue)
+
+    async def acquire(self, priority: Priority = Priority.BACKGROUND):
+        """Waits until a request of this priority is allowed to be made"""
+        future = asyncio.get_event_loop().create_future()
+        # [priority, sequence, future, throttled], sequence keeps the heap FIFO within a priority
+        heapq.heappush(self._queue, [priority, next(self._sequence), future, False])
+        self.stats['queued'] += 1
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._dispatcher())
+        self._wakeup.set()
+        await future
+
+    def update(self, headers: typing.Mapping[str, str]):
+        """Updates the bucket from a response's rate limit headers"""
+        try:
+            if "Ratelimit-Limit" in headers:
+                self.limit = int(headers['Ratelimit-Limit'])
+            if "Ratelimit-Remaining" in headers:
+                self.remaining = int(headers['Ratelimit-Remaining'])
+            if "Ratelimit-Reset" in headers:
+                self.reset = float(headers['Ratelimit-Reset'])
+        except ValueError:
+            log.warning(f"Malformed rate limit headers: {dict(headers)}")
+
+    def exhausted(self, headers: typing.Mapping[str, str]):
+        """Marks the bucket as empty after a 429, and counts the retry"""
+        self.update(headers)
+        self.remaining = 0
+        self.stats['retried'] += 1
+        self._wakeup.set()
+
+    async def _sleep(self, delay: float):
+        """Sleeps for the delay, or until something new is queued"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatcher(self):
+        while True:
+            # drop requests whose caller has gone away
+            while self._queue and self._queue[0][2].done():
+                heapq.heappop(self._queue)
+
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time()
+            if now >= self.reset:
+                self.remaining = self.limit
+                self.reset = now + self.window
+
+            if self.remaining <= 0:
+                for entry in self._queue:
+                    if not entry[3]:
+                        entry[3] = True
+                        self.stats['throttled'] += 1
+                log.debug(f"Rate limit exhausted, {self.pending} requests waiting {self.reset - now:.1f}s")
+                await asyncio.sleep(self.reset - now)
+                continue
+
+            entry = self._queue[0]
+            if entry[0] > Priority.INTERACTIVE:
+                if now < self._nextBackground:
+                    # an interactive request queued during this wait will be let through first
+                    await self._sleep(self._nextBackground - now)
+                    continue
+                self._nextBackground = now + (self.reset - now) / self.remaining
+
+            heapq.heappop(self._queue)
+            self.remaining -= 1
+            self.stats['dispatched'] += 1
+            entry[2].set_result(None)
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import traceback
+import typing
+from enum import Enum
+
+from . import utilities
+
+log: logging.Logger = utilities.getLog("streamState", logging.INFO)
+
+WENT_LIVE = "went_live"
+WENT_OFFLINE = "went_offline"
+TITLE_CHANGED = "title_changed"
+EVENTS = (WENT_LIVE, WENT_OFFLINE, TITLE_CHANGED)
+
+
+class State(Enum):
+    OFFLINE = "offline"
+    LIVE = "live"
+    ENDED = "ended"
+    """Went offline on the most recent update"""
+
+
+class StreamState:
+    """What we currently know about a streamer"""
+
+    __slots__ = ("userID", "state", "streamID", "startedAt", "title", "userData", "streamData", "firstSeen")
+
+    def __init__(self, userID: str):
+        self.userID = userID
+        self.state: State = State.OFFLINE
+        self.streamID: typing.Union[str, None] = None
+        self.startedAt: typing.Union[str, None] = None
+        self.title: typing.Union[str, None] = None
+
+        self.userData: typing.Union[dict, None] = None
+        """The most recent helix user data"""
+
+        self.streamData: typing.Union[dict, None] = None
+        """The most recent helix stream data, or the last stream's if they're offline"""
+
+        self.firstSeen = False
+        """Was the most recent update the first time we saw this streamer, so not necessarily a transition"""
+
+    @property
+    def live(self) -> bool:
+        return self.state == State.LIVE
+
+    @property
+    def login(self) -> typing.Union[str, None]:
+        return self.userData['login'] if self.userData else None
+
+
+Handler = typing.Callable[[StreamState], typing.Awaitable]
+
+
+class StreamStateTracker:
+    """Tracks every streamer's live state, and emits an event whenever it changes
+
+    Handlers are coroutines taking the streamer's StreamState. A streamer seen for the first time
+    emits went_live or went_offline, so handlers can reconcile anything left over from a previous run"""
+
+    def __init__(self):
+        self.states: typing.Dict[str, StreamState] = {}
+        self.handlers: typing.Dict[str, typing.List[Handler]] = {event: [] for event in EVENTS}
+
+    def subscribe(self, event: str, handler: Handler):
+        """Calls handler whenever event is emitted"""
+        if event not in self.handlers:
+            raise ValueError(f"Unknown event {event}, expected one of {', '.join(EVENTS)}")
+        self.handlers[event].append(handler)
+
+    def get(self, userID: str) -> typing.Union[StreamState, None]:
+        return self.states.get(userID)
+
+    @property
+    def liveCount(self) -> int:
+        return sum(1 for s in self.states.values() if s.live)
+
+    def forget(self, userID: str):
+        """Stops tracking a streamer, ie once nobody is subscribed to them"""
+        self.states.pop(userID, None)
+
+    async def _emit(self, event: str, state: StreamState):
+        for handler in self.handlers[event]:
+            try:
+                await handler(state)
+            except Exception as ex:
+                log.error('Ignoring exception in {} handler: {}'.format(
+                    event, "".join(traceback.format_exception(type(ex), ex, ex.__traceback__))))
+
+    def _transition(self, state: typing.Union[StreamState, None], userID: str, userData: dict,
+                    streamData: typing.Union[dict, None]) -> typing.Tuple[StreamState, typing.List[tuple]]:
+        """Applies new data to a streamer's state, returning the events it caused"""
+        events = []
+        firstSeen = state is None
+        if firstSeen:
+            state = StreamState(userID)
+        state.firstSeen = firstSeen
+        state.userData = userData
+
+        if streamData is None:
+            if state.live or firstSeen:
+                state.state = State.ENDED
+                events.append((WENT_OFFLINE, state))
+            else:
+                state.state = State.OFFLINE
+            return state, events
+
+        if state.live and state.streamID != streamData['id']:
+            # they restarted their stream between polls, end the old one first
+            ended = StreamState(userID)
+            ended.state = State.ENDED
+            ended.streamID, ended.startedAt, ended.title = state.streamID, state.startedAt, state.title
+            ended.userData, ended.streamData = userData, state.streamData
+            events.append((WENT_OFFLINE, ended))
+
+        if not state.live or state.streamID != streamData['id']:
+            state.state = State.LIVE
+            state.streamID = streamData['id']
+            state.startedAt = streamData.get('started_at')
+            state.title = streamData.get('title')
+            state.streamData = streamData
+            events.append((WENT_LIVE, state))
+        elif state.title != streamData.get('title'):
+            state.title = streamData.get('title')
+            state.streamData = streamData
+            events.append((TITLE_CHANGED, state))
+        else:
+            state.streamData = streamData
+        return state, events
+
+    async def _emitInOrder(self, changes: typing.List[tuple]):
+        for event, state in changes:
+            await self._emit(event, state)
+
+    async def update(self, users: typing.Dict[str, dict], streams: typing.Dict[str, dict]) -> typing.List[tuple]:
+        """Applies a poll's results, and emits events for every change
+
+        Streamers are handled concurrently, but each streamer's events are emitted in order,
+        so a restarted stream is always ended before the new one goes live
+
+        :param users: userID -> helix user data, for every streamer that was polled
+        :param streams: userID -> helix stream data, for those that are live
+        :return: every (event, state) emitted
+        """
+        allChanges = []
+        for userID, userData in users.items():
+            state, changes = self._transition(self.states.get(userID), userID, userData, streams.get(userID))
+            self.states[userID] = state
+            if changes:
+                allChanges.append(changes)
+
+        events = [event for changes in allChanges for event in changes]
+        if events:
+            log.debug(f"{len(events)} state changes: " +
+                      ", ".join(f"{state.login} {event}" for event, state in events))
+            await asyncio.gather(*[self._emitInOrder(changes) for changes in allChanges])
+        return events
+
+    async def setLive(self, userID: str, userData: dict, streamData: dict,
+                      firstSeen: bool = None) -> typing.List[tuple]:
+        """Marks a single streamer as live, ie from an eventsub notification, emitting any change
+
+        :param firstSeen: Overrides whether this counts as the first time they were seen, ie when another
+        worker saw the change"""
+        state, changes = self._transition(self.states.get(userID), userID, userData, streamData)
+        if firstSeen is not None:
+            state.firstSeen = firstSeen
+        self.states[userID] = state
+        await self._emitInOrder(changes)
+        return changes
+
+    async def setOffline(self, userID: str, userData: dict = None) -> typing.List[tuple]:
+        """Marks a single streamer as offline, ie from an eventsub notification, emitting any change"""
+        state = self.states.get(userID)
+        userData = (state.userData if state else None) or userData
+        if userData is None:
+            # we know nothing about them, so a later poll will reconcile them
+            return []
+        state, changes = self._transition(state, userID, userData, None)
+        self.states[userID] = state
+        await self._emitInOrder(changes)
+        return changes
@@ -1,26 +1,38 @@
+import asyncio
 import base64
-import binascii
+import json
 import logging
+import multiprocessing
 import os
 import pickle
+import tempfile
+import typing
+from collections import OrderedDict
+from concurrent.futures import Executor
+from concurrent.futures.process import BrokenProcessPool, ProcessPoolExecutor
 from concurrent.futures.thread import ThreadPoolExecutor
+from time import time
 
-import aiofiles as aiofiles
-import aiohttp
 import colorlog
-import numpy as np
-import scipy.cluster
-from PIL import Image
 from colorlog import ColoredFormatter
 
 import source.pagination as pagination
+from source.colour import dominantColour
 
 paginator = pagination
 
 thread_pool = ThreadPoolExecutor(max_workers=2)  # a thread pool
 
+USE_PROCESS_POOL = True
+"""Run image analysis in a process per core, rather than contending for the GIL in thread_pool"""
+
+_image_pool: typing.Union[ProcessPoolExecutor, None] = None
+
 discordCharLimit = 2000
 
+MAX_IMAGE_SIZE = 5 * 1024 * 1024
+"""The largest image getDominantColour will download"""
+
 logging.SPAM = 9
 logging.addLevelName(logging.SPAM, "SPAM")
 
@@ -63,6 +75,9 @@ def getLog(filename, level=logging.DEBUG) -> logging:
 
 log = getLog("utils")
 
+PERSIST_DELAY = 5
+"""Seconds a JSONPersister waits before writing, so a burst of changes is written once"""
+
 
 def getCredential(name: str):
     """Retrieves a stored credential
@@ -84,52 +99,201 @@ def getCredential(name: str):
     return credential
 
 
-async def getDominantColour(bot, imageURL):
-    """Returns the dominant colour of an image from URL"""
-
-    def blockFunc(imageDir):
-        """This is the actual MEAT that gets the dominant colour,
-        it is fairly computationally intensive, so i spin up a new thread
-        to avoid blocking the main bot thread"""
-        # log.debug("Reading image...")
-        im = Image.open(imageDir)
-
-        im = im.resize((100, 100), Image.NEAREST)
-
-        ar = np.asarray(im)
-        shape = ar.shape
-        ar = ar.reshape(np.product(shape[:2]), shape[2]).astype(float)
-
-        # log.debug("Finding Clusters")
-        codes, dist = scipy.cluster.vq.kmeans(ar, 5)
-
-        # log.debug("Clusters found")
-        vecs, dist = scipy.cluster.vq.vq(ar, codes)  # assign codes
-        counts, bins = np.histogram(vecs, len(codes))  # count occurrences
-
-        # log.debug("Processing output")
-
-        maxSorted = counts.argsort().tolist()
-        maxSorted.reverse()
-        for i in range(len(maxSorted)):
-            peak = codes[maxSorted[i]]
-            c = binascii.hexlify(bytearray(int(c) for c in peak)).decode('ascii')
-            if c != '00000000' and c != '00000001':
-                return c
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get(imageURL) as r:
-            # Asynchronously get image from url
-            if r.status == 200:
-                name = imageURL.split("/")[-1]
-                f = await aiofiles.open(name, mode="wb")
-                await f.write(await r.read())
-                await f.close()
-
-                loop = bot.loop
-                colour = await loop.run_in_executor(thread_pool, blockFunc, name)
-                os.unlink(name)
-                colour = tuple(int(colour[i:i + 2], 16) for i in (0, 2, 4))
-                colour = (colour[0] << 16) + (colour[1] << 8) + colour[2]
-                return colour
+def writeJSON(path: str, data):
+    """Atomically replaces a json file, safe to call from a thread"""
+    directory, name = os.path.split(path)
+    fd, tmpPath = tempfile.mkstemp(prefix=f"{name}.", suffix=".tmp", dir=directory or ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmpPath, path)
+    except BaseException:
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+        raise
+
+
+class JSONPersister:
+    """Writes snapshots of some in-memory state to a json file, without blocking the event loop
+
+    Writes are debounced, so any number of changes within `delay` seconds are written once,
+    and only one write is ever in flight"""
+
+    def __init__(self, path: str, snapshot: typing.Callable[[], typing.Any], name: str,
+                 delay: float = PERSIST_DELAY):
+        self.path = path
+        self.snapshot = snapshot
+        """Returns a json serializable copy of the state, called on the event loop"""
+
+        self.name = name
+        self.delay = delay
+        self._lock: typing.Union[asyncio.Lock, None] = None
+        self._pending: typing.Union[asyncio.Future, None] = None
+        self._dirty = False
+
+    def schedule(self):
+        """Writes the state in `delay` seconds, if a write isn't already waiting"""
+        self._dirty = True
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._writeLater())
+
+    async def _writeLater(self):
+        await asyncio.sleep(self.delay)
+        # anything changed from here on needs a write of its own
+        self._pending = None
+        await self.flush()
+
+    async def flush(self):
+        """Writes the state now, if it has changed since it was last written"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            data = self.snapshot()
+            try:
+                await asyncio.get_event_loop().run_in_executor(thread_pool, writeJSON, self.path, data)
+            except OSError as e:
+                log.warning(f"Failed to persist {self.name}: {e}")
+
+
+class ColourCache:
+    """A bounded LRU cache of image URL -> dominant colour, persisted to disk
+
+    Twitch profile image URLs change when the image does, so entries can live a long time"""
+
+    def __init__(self, maxSize: int = 2048, ttl: float = 7 * 24 * 60 * 60, path: str = "data/colourCache.json"):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.path = path
+
+        self.entries: typing.OrderedDict[str, typing.Tuple[int, float]] = OrderedDict()
+        """URL -> (colour, time stored), least recently used first"""
+
+        self.hits = 0
+        self.misses = 0
+        self._loaded = False
+        self.persister = JSONPersister(path, lambda: {url: list(entry) for url, entry in self.entries.items()},
+                                       "colour cache")
+
+    def load(self):
+        """Loads persisted entries, if there are any"""
+        self._loaded = True
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            log.warning(f"Discarding malformed colour cache: {e}")
+            return
+        now = time()
+        for url, (colour, stored) in data.items():
+            if now - stored < self.ttl:
+                self.entries[url] = (colour, stored)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def get(self, url: str) -> typing.Union[int, None]:
+        """Gets a cached colour, or None if it isn't cached or has expired"""
+        if not self._loaded:
+            self.load()
+        entry = self.entries.get(url)
+        if entry is not None and time() - entry[1] < self.ttl:
+            self.entries.move_to_end(url)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self.entries[url]
+        self.misses += 1
+        return None
+
+    def set(self, url: str, colour: int):
+        """Caches a colour, evicting the least recently used entry if full"""
+        self.entries[url] = (colour, time())
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def persist(self):
+        """Schedules the cache to be written to disk"""
+        self.persister.schedule()
+
+    @property
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+colourCache = ColourCache()
+
+
+def getImagePool() -> Executor:
+    """Gets the executor CPU bound image work should be run in"""
+    global _image_pool
+    if not USE_PROCESS_POOL:
+        return thread_pool
+    if _image_pool is None:
+        # spawn rather than fork, forking a process with a running event loop and threads isn't safe
+        workers = os.cpu_count() or 1
+        _image_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        log.debug(f"Started image process pool with {workers} workers")
+    return _image_pool
+
+
+def discardImagePool(pool: Executor):
+    """Forgets a broken image pool, ie after one of its processes died, so the next call starts a new one"""
+    global _image_pool
+    if _image_pool is pool:
+        log.warning("Image process pool is broken, restarting it")
+        _image_pool.shutdown(wait=False)
+        _image_pool = None
+
+
+def shutdownImagePool():
+    """Stops the image process pool, if it was started"""
+    global _image_pool
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=False)
+        _image_pool = None
+
+
+async def getDominantColour(bot, imageURL, backend: str = None):
+    """Returns the dominant colour of an image from URL, or None if the image couldn't be fetched,
+    is too large, or is fully transparent
+
+    :param backend: The colour extraction backend to use, see `colour.BACKENDS`"""
+    colour = colourCache.get(imageURL)
+    if colour is not None:
+        return colour
+
+    async with bot.session.get(imageURL) as r:
+        # Asynchronously get image from url
+        if r.status == 200:
+            if (r.content_length or 0) > MAX_IMAGE_SIZE:
+                log.warning(f"Refusing to process {imageURL}, {r.content_length} bytes is too large")
+                return None
+            imageData = bytearray()
+            async for chunk in r.content.iter_chunked(64 * 1024):
+                imageData += chunk
+                if len(imageData) > MAX_IMAGE_SIZE:
+                    log.warning(f"Refusing to process {imageURL}, it is too large")
+                    return None
+
+            # this is fairly computationally intensive, so run it in another process
+            # to avoid blocking the main bot thread
+            loop = bot.loop
+            pool = getImagePool()
+            try:
+                colour = await loop.run_in_executor(pool, dominantColour, bytes(imageData), backend)
+            except BrokenProcessPool:
+                discardImagePool(pool)
+                raise
+            if colour is None:
+                return None
+            colourCache.set(imageURL, colour)
+            colourCache.persist()
+            return colour
     return None
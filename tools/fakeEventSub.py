@@ -0,0 +1,112 @@
+"""Sends signed eventsub deliveries to a local receiver, to test the bot without twitch
+
+Usage:
+    python tools/fakeEventSub.py online <user id> <login> [--stream-id ID]
+    python tools/fakeEventSub.py offline <user id> <login>
+    python tools/fakeEventSub.py challenge
+    python tools/fakeEventSub.py online <user id> <login> --bad-signature
+
+The secret must match the bot's eventSubSecret credential. Each delivery gets a fresh message ID,
+use --repeat to send the same message more than once and check it is deduplicated
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import typing
+import uuid
+from datetime import datetime, timezone
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from source.eventsub import sign, STREAM_ONLINE, STREAM_OFFLINE  # noqa: E402
+
+
+def timestamp() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f000Z")
+
+
+def subscription(subType: str, userID: str) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "status": "enabled",
+        "type": subType,
+        "version": "1",
+        "cost": 1,
+        "condition": {"broadcaster_user_id": userID},
+        "transport": {"method": "webhook", "callback": "https://localhost/eventsub"},
+        "created_at": timestamp()
+    }
+
+
+def buildMessage(args) -> typing.Tuple[str, dict]:
+    """Builds the message type and payload for the chosen command"""
+    if args.command == "challenge":
+        return "webhook_callback_verification", {
+            "challenge": uuid.uuid4().hex,
+            "subscription": subscription(STREAM_ONLINE, args.userID or "0")
+        }
+
+    event = {
+        "broadcaster_user_id": args.userID,
+        "broadcaster_user_login": args.login.lower(),
+        "broadcaster_user_name": args.login,
+    }
+    if args.command == "online":
+        event.update({
+            "id": args.streamID or str(uuid.uuid4().int)[:11],
+            "type": "live",
+            "started_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        })
+    subType = STREAM_ONLINE if args.command == "online" else STREAM_OFFLINE
+    return "notification", {"subscription": subscription(subType, args.userID), "event": event}
+
+
+async def send(args):
+    messageType, payload = buildMessage(args)
+    body = json.dumps(payload).encode("utf-8")
+    messageID = str(uuid.uuid4())
+    sentAt = timestamp()
+    signature = sign(args.secret, messageID, sentAt, body)
+    if args.bad_signature:
+        signature = sign(args.secret + "wrong", messageID, sentAt, body)
+
+    headers = {
+        "Content-Type": "application/json",
+        "Twitch-Eventsub-Message-Id": messageID,
+        "Twitch-Eventsub-Message-Timestamp": sentAt,
+        "Twitch-Eventsub-Message-Signature": signature,
+        "Twitch-Eventsub-Message-Type": messageType,
+        "Twitch-Eventsub-Subscription-Type": payload['subscription']['type'],
+        "Twitch-Eventsub-Subscription-Version": "1",
+    }
+    async with aiohttp.ClientSession() as session:
+        for _ in range(args.repeat):
+            async with session.post(args.url, data=body, headers=headers) as r:
+                print(f"{messageType} {payload['subscription']['type']} -> {r.status} {await r.text()}")
+            if messageType == "webhook_callback_verification":
+                print(f"expected challenge {payload['challenge']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("online", "offline", "challenge"))
+    parser.add_argument("userID", nargs="?", help="The broadcaster's user ID")
+    parser.add_argument("login", nargs="?", help="The broadcaster's login")
+    parser.add_argument("--stream-id", dest="streamID", help="The stream ID to send, random by default")
+    parser.add_argument("--url", default="http://localhost:8080/eventsub")
+    parser.add_argument("--secret", default=os.environ.get("EVENTSUB_SECRET", "secret"),
+                        help="The webhook secret, defaults to $EVENTSUB_SECRET")
+    parser.add_argument("--repeat", type=int, default=1, help="How many times to deliver the message")
+    parser.add_argument("--bad-signature", action="store_true", help="Sign with the wrong secret")
+    args = parser.parse_args()
+    if args.command != "challenge" and not (args.userID and args.login):
+        parser.error(f"{args.command} needs a user ID and login")
+    asyncio.get_event_loop().run_until_complete(send(args))
+
+
+if __name__ == '__main__':
+    main()